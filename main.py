@@ -2,26 +2,48 @@ import os
 import json
 import asyncio
 import base64
+import hashlib
 import time
+import random
+import functools
+import dataclasses
+from collections import OrderedDict
 from typing import Optional
+from datetime import date, timedelta
 from fastapi import FastAPI, Request, HTTPException
 from pydantic import BaseModel
 from typing import List, Optional
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import httpx
 import jwt as pyjwt
 from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from dotenv import load_dotenv
-from service.namecheap import fetch_namecheap, fetch_domain_dns_records, set_domain_dns_records
+from service.namecheap import fetch_namecheap, fetch_balances, fetch_domain_dns_records, set_domain_dns_records
+from service.namecheap import normalize_domain, diff_dns_records
+from service.quota import BULK, INTERACTIVE
 from service.whm import get_bandwidth as whm_get_bandwidth
 from service.hestia import fetch_all as hestia_fetch_all
+from service.state import StateStore
+from service.upload import post_in_batches
+from service.pipeline import Pipeline
+from service.dns_cache import DNSCache
+from service.normalize import normalize_domains
+from service.domain_index import DomainIndex
+from service.jobs import SyncRunner, report_progress, set_progress
+from service.leader import LeaderElector, process_id
+from service.schedule import SourceSchedule, SourceScheduler, FairLimiter
+from service.targets import Target, NamecheapAccount, load_targets
+from service.clients import ClientRegistry, UpstreamSettings
+from service.serialize import dumps
+from service.bandwidth import snapshot_totals, bandwidth_deltas
 
-_jwks_lock = asyncio.Lock()
 _jwks_fetched_at = 0
-JWKS_TTL = 3600
+_jwks_attempted_at = 0
+_jwks_refresh_task = None
+# spreads the scheduled JWKS refresh of several workers apart
+_jwks_refresh_jitter = random.uniform(0, 0.1)
 
 load_dotenv()
 
@@ -29,80 +51,263 @@ CERTS_API_URL = os.getenv("CERTS_API_URL")
 IS_PRODUCTION = os.getenv("NODE_ENV") == "production"
 CLIENT_URL = os.getenv("CLIENT_URL")
 PORT = int(os.getenv("PORT", 3001))
-NAME = os.getenv("NAME")
-CLIENT_IP = os.getenv("CLIENT_IP")
 SERVER_API_URL = os.getenv("SERVER_API_URL")
 SERVER_API_TOKEN = os.getenv("SERVER_API_TOKEN")
-TEAM = os.getenv("TEAM")
-NO_NC = os.getenv("NO_NC", "false").lower() == "true"
 DRY_RUN = os.getenv("DRY_RUN", "false").lower() == "true"
-API_USER = os.getenv("API_USER")
 DEBUG = os.getenv("DEBUG", "false").lower() == "true"
-PANEL_TYPE = os.getenv("PANEL_TYPE", "whm")
+JWKS_TTL = int(os.getenv("JWKS_TTL", 3600))
+# shortest gap between two refetches triggered by tokens with an unknown kid
+JWKS_REFETCH_INTERVAL = int(os.getenv("JWKS_REFETCH_INTERVAL", 30))
+# how long a kid that is still missing after a refetch is rejected outright
+JWKS_NEGATIVE_TTL = int(os.getenv("JWKS_NEGATIVE_TTL", 60))
+# how long a request with an unknown kid may wait for the refetch it triggered
+JWKS_UNKNOWN_KID_WAIT = float(os.getenv("JWKS_UNKNOWN_KID_WAIT", 2))
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", 1024))
+STATE_DB = os.getenv("STATE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "state.db"))
+# upload only added/changed/removed domains; the backend must serve /api/domains/delta
+DELTA_SYNC = os.getenv("DELTA_SYNC", "false").lower() == "true"
+FULL_SYNC_INTERVAL = int(os.getenv("FULL_SYNC_INTERVAL", 24 * 60 * 60))
+# batching (0 = one request) and gzip need backend support, so both are opt-in
+UPLOAD_BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", 0))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 2))
+UPLOAD_GZIP = os.getenv("UPLOAD_GZIP", "false").lower() == "true"
+DNS_CACHE_TTL = int(os.getenv("DNS_CACHE_TTL", 300))
+DNS_CACHE_SIZE = int(os.getenv("DNS_CACHE_SIZE", 1000))
+BULK_DNS_CONCURRENCY = int(os.getenv("BULK_DNS_CONCURRENCY", 4))
+# send per-interval bandwidth deltas from the local history instead of the showbw snapshot
+BANDWIDTH_DELTAS = os.getenv("BANDWIDTH_DELTAS", "false").lower() == "true"
+BANDWIDTH_HISTORY_DAYS = int(os.getenv("BANDWIDTH_HISTORY_DAYS", 90))
+SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL", 6 * 60 * 60))
+# each source is synced and pushed on its own interval (seconds)
+BALANCES_INTERVAL = int(os.getenv("BALANCES_INTERVAL", 60 * 60))
+BANDWIDTH_INTERVAL = int(os.getenv("BANDWIDTH_INTERVAL", 60 * 60))
+INVENTORY_INTERVAL = int(os.getenv("INVENTORY_INTERVAL", SYNC_INTERVAL))
+# +/- fraction of randomness added to every delay
+SCHEDULE_JITTER = float(os.getenv("SCHEDULE_JITTER", 0.1))
+# a source that keeps coming back unchanged is synced up to this many times less often
+SCHEDULE_MAX_FACTOR = float(os.getenv("SCHEDULE_MAX_FACTOR", 4))
+# first retry after a failed run, doubling per failure up to the source's interval
+SCHEDULE_RETRY_MIN = int(os.getenv("SCHEDULE_RETRY_MIN", 60))
+# worker processes sharing STATE_DB elect one leader to run the scheduled sync
+LEADER_LEASE_TTL = int(os.getenv("LEADER_LEASE_TTL", 30))
+# how often every worker picks up the leader's domain index, sync result and JWKS
+SHARED_STATE_POLL = int(os.getenv("SHARED_STATE_POLL", 10))
+# JSON file listing several panels and NameCheap accounts to sync from one
+# process; without it the one target is described by NAME, CLIENT_IP, PANEL_TYPE...
+TARGETS_FILE = os.getenv("TARGETS_FILE")
+# how many scheduled source runs may be in progress at once, over all targets
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", 4))
 
-app = FastAPI()
+# Every upstream gets its own connection pool; each setting can be changed
+# with HTTP_<UPSTREAM>_<SETTING> (see service/clients.py) or under "http"
+# in TARGETS_FILE.
+_UPSTREAMS = {
+    "namecheap": UpstreamSettings(max_connections=10, max_keepalive=5, timeout=30, pool_timeout=60),
+    "backend": UpstreamSettings(max_connections=20, max_keepalive=10, timeout=30),
+    "jwks": UpstreamSettings(max_connections=4, max_keepalive=2, timeout=10, pool_timeout=5),
+    "whm": UpstreamSettings(max_connections=20, max_keepalive=5, timeout=30, verify=False),
+    "hestia": UpstreamSettings(max_connections=10, max_keepalive=8, timeout=30, verify=False),
+}
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+app = FastAPI(default_response_class=FastJSONResponse)
+
+dns_cache = DNSCache(ttl=DNS_CACHE_TTL, max_size=DNS_CACHE_SIZE)
 
 origins = [CLIENT_URL] if IS_PRODUCTION and CLIENT_URL else ["*"]
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
-    allow_methods=["GET", "POST", "PUT", "DELETE"],
-    allow_headers=["Authorization", "Content-Type"],
+    allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE"],
+    allow_headers=["Authorization", "Content-Type", "If-None-Match"],
+    expose_headers=["ETag"],
 )
 
 _jwks_cache = {"keys": []}
+# kid -> ready-to-use RSA public key, rebuilt whenever the JWKS changes
+_jwks_keys = {}
+# sha256(token) -> (decoded claims, exp), least recently used first
+_verified_tokens = OrderedDict()
+# kid -> time until which it is rejected without asking CERTS_API_URL again
+_unknown_kids = {}
 
-async def _fetch_jwks(request: Request):
-    global _jwks_cache, _jwks_fetched_at
+async def _fetch_jwks(client: httpx.AsyncClient):
+    global _jwks_fetched_at, _jwks_attempted_at
 
     if not CERTS_API_URL:
         return None
 
-    now = time.time()
-    if _jwks_cache.get("keys") and now - _jwks_fetched_at < JWKS_TTL:
+    # another worker may just have fetched it
+    if _adopt_shared_jwks(await asyncio.to_thread(_load_shared_jwks), max_age=JWKS_REFETCH_INTERVAL):
         return _jwks_cache
 
-    async with _jwks_lock:
-        if _jwks_cache.get("keys") and now - _jwks_fetched_at < JWKS_TTL:
-            return _jwks_cache
+    _jwks_attempted_at = time.time()
+    r = await client.get(CERTS_API_URL)
+    r.raise_for_status()
 
-        client = request.app.state.http_client
-        r = await client.get(CERTS_API_URL)
-        r.raise_for_status()
+    _set_jwks(r.json())
+    _jwks_fetched_at = time.time()
+    await _save_jwks()
+    return _jwks_cache
+
+
+async def _save_jwks():
+    store = getattr(app.state, "state_store", None)
+    if store:
+        try:
+            saved = {"jwks": _jwks_cache, "fetchedAt": _jwks_fetched_at, "url": CERTS_API_URL}
+            await asyncio.to_thread(store.set, "jwks", saved)
+        except Exception as e:
+            print(f"Failed to save JWKS snapshot: {e}")
+
+
+def _load_shared_jwks() -> Optional[dict]:
+    """The JWKS snapshot in the state file, if any. Blocking."""
+    store = getattr(app.state, "state_store", None)
+    return store.get("jwks") if store else None
+
+
+def _adopt_shared_jwks(saved: Optional[dict], max_age: float = None) -> bool:
+    """Take `saved` (from _load_shared_jwks) if it is newer than our JWKS.
+
+    It must also be younger than JWKS_TTL (or `max_age`). That covers
+    restarts and copies fetched by other workers.
+    """
+    global _jwks_fetched_at
+
+    if not saved or saved.get("url") != CERTS_API_URL or saved["fetchedAt"] <= _jwks_fetched_at:
+        return False
+    if time.time() - saved["fetchedAt"] >= (JWKS_TTL if max_age is None else max_age):
+        return False
+    _set_jwks(saved["jwks"])
+    _jwks_fetched_at = saved["fetchedAt"]
+    return True
+
+
+def _refresh_jwks(client: httpx.AsyncClient) -> asyncio.Task:
+    """Start a JWKS fetch, or return the one already in flight."""
+    global _jwks_refresh_task
+
+    if _jwks_refresh_task is None or _jwks_refresh_task.done():
+        _jwks_refresh_task = asyncio.create_task(_fetch_jwks(client))
+        # failures are reported to whoever awaits; don't warn about the rest
+        _jwks_refresh_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return _jwks_refresh_task
 
-        _jwks_cache = r.json()
-        _jwks_fetched_at = time.time()
-        return _jwks_cache
+
+async def _jwks_refresh_loop(client: httpx.AsyncClient):
+    """Keep the JWKS fresh so request handlers never have to fetch it."""
+    retry = 5
+    while True:
+        wait = _jwks_fetched_at + JWKS_TTL * (0.8 - _jwks_refresh_jitter) - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+            continue
+        try:
+            await _refresh_jwks(client)
+            retry = 5
+        except Exception as e:
+            print(f"JWKS refresh failed (retrying in {retry}s): {e}")
+            await asyncio.sleep(retry)
+            retry = min(retry * 2, 300)
+
+
+def _set_jwks(jwks: dict):
+    """Swap in a new JWKS and rebuild the kid index from it."""
+    global _jwks_cache, _jwks_keys
+
+    keys = {}
+    for key in jwks.get("keys", []):
+        kid = key.get("kid")
+        if not kid or key.get("kty") != "RSA" or kid in keys:
+            continue
+        public_key = _rsa_key_from_jwks(key)
+        if public_key is not None:
+            keys[kid] = public_key
+
+    _jwks_cache = jwks
+    _jwks_keys = keys
+    for kid in keys:
+        _unknown_kids.pop(kid, None)
+    # a token verified against a key that is gone must be checked again
+    _verified_tokens.clear()
 
 
-def _rsa_key_from_jwks(jwks_key: dict) -> Optional[bytes]:
-    """Convert JWKS RSA key to PEM format."""
+def _rsa_key_from_jwks(jwks_key: dict) -> Optional[rsa.RSAPublicKey]:
+    """Build an RSA public key object from a JWKS entry."""
     try:
         e = int.from_bytes(base64.urlsafe_b64decode(jwks_key['e'] + '=='), 'big')
         n = int.from_bytes(base64.urlsafe_b64decode(jwks_key['n'] + '=='), 'big')
         public_numbers = rsa.RSAPublicNumbers(e, n)
-        public_key = public_numbers.public_key(default_backend())
-        pem = public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-        return pem
+        return public_numbers.public_key(default_backend())
     except Exception:
         return None
 
-async def _get_public_key_for_kid(kid: str, request: Request) -> Optional[bytes]:
-    if not _jwks_cache.get("keys"):
-        await _fetch_jwks(request)
+async def _get_public_key_for_kid(kid: str, client: httpx.AsyncClient) -> Optional[rsa.RSAPublicKey]:
+    public_key = _jwks_keys.get(kid)
+    if public_key is not None:
+        return public_key
+
+    if not _jwks_fetched_at:
+        # cold start: nothing to verify against until the first fetch lands
+        await _refresh_jwks(client)
+        return _jwks_keys.get(kid)
+
+    now = time.time()
+    if _unknown_kids.get(kid, 0) > now:
+        return None
 
-    for key in _jwks_cache.get("keys", []):
-        if key.get("kid") == kid and key.get("kty") == "RSA":
-            return _rsa_key_from_jwks(key)
+    # an unknown kid usually means the keys were rotated; all requests
+    # carrying it share one refetch, and refetches are spaced out
+    in_flight = _jwks_refresh_task is not None and not _jwks_refresh_task.done()
+    if not in_flight and now - _jwks_attempted_at < JWKS_REFETCH_INTERVAL:
+        return None
+
+    task = _refresh_jwks(client)
+    try:
+        await asyncio.wait_for(asyncio.shield(task), JWKS_UNKNOWN_KID_WAIT)
+    except Exception as e:
+        print(f"JWKS refetch for kid {kid} failed: {e!r}")
 
-    return None
+    public_key = _jwks_keys.get(kid)
+    if public_key is None and task.done() and not task.cancelled() and not task.exception():
+        if len(_unknown_kids) >= 1024:
+            _unknown_kids.clear()
+        _unknown_kids[kid] = time.time() + JWKS_NEGATIVE_TTL
+    return public_key
+
+
+def _get_verified_token(digest: bytes) -> Optional[dict]:
+    entry = _verified_tokens.get(digest)
+    if entry is None:
+        return None
+    decoded, exp = entry
+    if exp <= time.time():
+        del _verified_tokens[digest]
+        return None
+    _verified_tokens.move_to_end(digest)
+    return decoded
+
+
+def _remember_verified_token(digest: bytes, decoded: dict):
+    exp = decoded.get("exp")
+    # without exp there is nothing to evict the entry at, so always re-verify
+    if JWT_CACHE_SIZE <= 0 or not isinstance(exp, (int, float)):
+        return
+    _verified_tokens[digest] = (decoded, float(exp))
+    _verified_tokens.move_to_end(digest)
+    while len(_verified_tokens) > JWT_CACHE_SIZE:
+        _verified_tokens.popitem(last=False)
+
+# readiness probes can't present a token
+_PUBLIC_PATHS = {"/ready"}
 
 @app.middleware("http")
 async def verify_jwt_middleware(request: Request, call_next):
-    if request.method == "OPTIONS":
+    if request.method == "OPTIONS" or request.url.path in _PUBLIC_PATHS:
         return await call_next(request)
 
     auth = request.headers.get("authorization")
@@ -120,6 +325,12 @@ async def verify_jwt_middleware(request: Request, call_next):
         )
 
     token = parts[1]
+    digest = hashlib.sha256(token.encode()).digest()
+
+    cached = _get_verified_token(digest)
+    if cached is not None:
+        request.state.user = cached
+        return await call_next(request)
 
     try:
         header = pyjwt.get_unverified_header(token)
@@ -130,8 +341,8 @@ async def verify_jwt_middleware(request: Request, call_next):
                 content={"detail": "Token header missing kid"},
             )
 
-        pub_pem = await _get_public_key_for_kid(kid, request)
-        if not pub_pem:
+        public_key = await _get_public_key_for_kid(kid, _client("jwks"))
+        if public_key is None:
             return JSONResponse(
                 status_code=401,
                 content={"detail": "Public key for kid not found"},
@@ -139,11 +350,12 @@ async def verify_jwt_middleware(request: Request, call_next):
 
         decoded = pyjwt.decode(
             token,
-            pub_pem,
+            public_key,
             algorithms=["RS256"],
             options={"verify_aud": False},
         )
 
+        _remember_verified_token(digest, decoded)
         request.state.user = decoded
 
     except pyjwt.ExpiredSignatureError:
@@ -160,132 +372,862 @@ async def verify_jwt_middleware(request: Request, call_next):
     return await call_next(request)
 
 
-async def send_domains_to_server(domains, balances, bandwidth):
-    client = app.state.http_client
+def _load_targets() -> tuple[list, dict]:
+    """Returns (targets, top-level options) from TARGETS_FILE or the env."""
+    if not TARGETS_FILE:
+        return [Target.from_env()], {}
+    return load_targets(TARGETS_FILE, upstreams=_UPSTREAMS)
+
+
+def _build_clients(overrides: dict) -> ClientRegistry:
+    clients = ClientRegistry()
+    for name, defaults in _UPSTREAMS.items():
+        settings = defaults.with_env(name)
+        if name in overrides:
+            settings = dataclasses.replace(settings, **overrides[name])
+        clients.add(name, settings)
+    return clients
+
+
+def _client(upstream: str) -> httpx.AsyncClient:
+    return app.state.clients.get(upstream)
+
+
+def _target_store(target: Target):
+    """The state file of a target from TARGETS_FILE sits next to STATE_DB,
+    one per target; the env-configured target uses STATE_DB itself."""
+    store = getattr(app.state, "state_store", None)
+    if store is None or not target.key:
+        return store
+    path = os.path.join(os.path.dirname(STATE_DB), "targets", f"{target.name}.db")
+    try:
+        return StateStore(path)
+    except Exception as e:
+        print(f"State store {path} of target {target.name} unavailable, its state will not persist: {e}")
+        return None
+
+
+def _find_target(name: Optional[str]) -> Optional[Target]:
+    targets = app.state.targets
+    if name is None:
+        return next(iter(targets.values())) if len(targets) == 1 else None
+    return targets.get(name)
+
+
+def _get_target(name: Optional[str]) -> Target:
+    target = _find_target(name)
+    if target is None:
+        if name is None:
+            raise HTTPException(status_code=400, detail="Invalid request: target is required")
+        raise HTTPException(status_code=404, detail=f"Unknown target {name}")
+    return target
+
+
+# teamId/accountId from the backend are kept in target.identity, reused
+# across cycles and restarts
+
+def _identity_scope(target: Target) -> list:
+    return [SERVER_API_URL, target.team, target.name]
+
+
+def _load_identity(target: Target):
+    saved = target.store.get("identity") if target.store else None
+    target.identity.clear()
+    if saved and saved.get("scope") == _identity_scope(target):
+        target.identity.update(saved)
+        if saved.get("fingerprintFormat") != _FINGERPRINT_FORMAT:
+            target.identity.pop("sliceHashes", None)
+
+
+async def _save_identity(target: Target):
+    if target.store:
+        await asyncio.to_thread(
+            target.store.set,
+            "identity",
+            {**target.identity, "scope": _identity_scope(target), "fingerprintFormat": _FINGERPRINT_FORMAT},
+        )
+
+
+async def _invalidate_identity(target: Target):
+    target.identity.clear()
+    await _save_identity(target)
+
+
+def _is_rejection(e: BaseException) -> bool:
+    """True if the backend refused the request, e.g. for an unknown id."""
+    while e is not None:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code in (400, 404, 409, 410, 422):
+            return True
+        e = e.__cause__
+    return False
+
+
+async def _update_team(client: httpx.AsyncClient, target: Target) -> tuple:
+    """Returns (team_id, whether it came from the cache)."""
+    identity = target.identity
+    if identity.get("teamId") is not None:
+        return identity["teamId"], True
+
     team_resp = await client.post(
         f"{SERVER_API_URL}/api/team/update-team",
-        json={"name": TEAM},
+        content=dumps({"name": target.team}),
         headers={"Authorization": f"Bearer {SERVER_API_TOKEN}", "Content-Type": "application/json"},
     )
     team_resp.raise_for_status()
     team_id = team_resp.json().get("teamId")
+    if team_id is not None:
+        identity.clear()
+        identity["teamId"] = team_id
+        await _save_identity(target)
+    return team_id, False
+
+
+def _balances_slice(balances) -> dict:
+    return {
+        "availableBalance": balances.get("availableBalance") if balances else 0.00,
+        "fundsRequiredForAutoRenew": balances.get("fundsRequiredForAutoRenew") if balances else 0.00,
+    }
+
+
+async def _update_account(
+    client: httpx.AsyncClient, target: Target, team_id, slices: dict, force: bool = False
+) -> tuple:
+    """Returns (account_id, whether it came from the cache, whether the
+    backend accepted a POST of `slices`).
+
+    `slices` maps a slice name ("balances", "bandwidth") to the account
+    fields it sets; only those fields are posted, next to the account's
+    identifying ones. Nothing is posted when none of them changed since
+    they were last accepted, unless `force` is set: bandwidth deltas can
+    repeat and must still be sent.
+    """
     account_data = {
-        "server_name": NAME,
+        "server_name": target.name,
         "hosting_price": 0.00,
         "team_id": team_id,
-        "availableBalance": balances.get("availableBalance") if balances else 0.00,
-        "fundsRequiredForAutoRenew": balances.get("fundsRequiredForAutoRenew") if balances else 0.00,
-        "client_ip": CLIENT_IP,
-        "panel": PANEL_TYPE,
-        "bandwidth": bandwidth,
+        "client_ip": target.host,
+        "panel": target.panel,
     }
+    hashes = {"account": _fingerprint(account_data)}
+    for name, fields in slices.items():
+        account_data.update(fields)
+        hashes[name] = _fingerprint(fields)
+    identity = target.identity
+    known = identity.get("sliceHashes", {})
+    if not force and identity.get("accountId") is not None and all(known.get(k) == h for k, h in hashes.items()):
+        return identity["accountId"], True, False
+
     acc_resp = await client.post(
         f"{SERVER_API_URL}/api/team/update-account",
-        json=account_data,
+        content=dumps(account_data),
         headers={"Authorization": f"Bearer {SERVER_API_TOKEN}", "Content-Type": "application/json"},
     )
     acc_resp.raise_for_status()
     account_id = acc_resp.json().get("accountId")
+    if account_id is not None:
+        identity.update(sliceHashes={**known, **hashes}, accountId=account_id)
+        await _save_identity(target)
+    return account_id, False, True
+
+
+async def _resolve_account(
+    client: httpx.AsyncClient, target: Target, team, slices: dict, force: bool = False
+) -> tuple:
+    """Update the account, starting over once if a cached team id is refused."""
+    team_id, team_cached = team
+    try:
+        return await _update_account(client, target, team_id, slices, force)
+    except Exception as e:
+        if not (team_cached and _is_rejection(e)):
+            raise
+    await _invalidate_identity(target)
+    team_id, _ = await _update_team(client, target)
+    return await _update_account(client, target, team_id, slices, force)
+
+
+async def _send_domains(
+    client: httpx.AsyncClient, target: Target, account, domains: list, complete: bool, slices: dict
+):
+    """send_domains_to_server(), getting fresh ids and retrying once if the
+    cached account id turns out to be stale."""
+    account_id, account_cached, _ = account
+    try:
+        return await send_domains_to_server(target, account_id, domains, complete=complete)
+    except Exception as e:
+        if not (account_cached and _is_rejection(e)):
+            raise
+    await _invalidate_identity(target)
+    team = await _update_team(client, target)
+    account_id, _, _ = await _resolve_account(client, target, team, slices)
+    await send_domains_to_server(target, account_id, domains, complete=complete)
+
+
+def _default_user(target: Target) -> Optional[str]:
+    return target.namecheap.api_user if target.namecheap else None
+
+
+async def send_domains_to_server(target: Target, account_id, domains, complete: bool = True):
+    client = _client("backend")
     if not (isinstance(domains, list) and domains):
         return
-    domain_data_array = []
-    for domain in domains:
-        attrs = {}
-        if isinstance(domain, dict):
-            if "$" in domain and isinstance(domain["$"], dict):
-                attrs = domain["$"]
-            elif "@" in domain and isinstance(domain["@"], dict):
-                attrs = domain["@"]
-            else:
-                has_at_keys = any(k.startswith("@") for k in domain.keys())
-                if has_at_keys:
-                    for k, v in domain.items():
-                        attrs[k[1:] if isinstance(k, str) and k.startswith("@") else k] = v
-                else:
-                    attrs = domain.copy()
-        def get_attr(*names, default=None):
-            for n in names:
-                if n is None:
-                    continue
-                v = attrs.get(n)
-                if v is not None:
-                    return v
-            return default
-        name = get_attr("Name", "name")
-        if not name:
-            continue
-        auto_renew_raw = get_attr("AutoRenew", "autoRenew", "auto_renew", default="false")
-        created_raw = get_attr("Created", "created")
-        expires_raw = get_attr("Expires", "expires")
-        isexpired_raw = get_attr("IsExpired", "isExpired", "is_expired", default="false")
-        islocked_raw = get_attr("IsLocked", "isLocked", "is_locked", default="false")
-        isourdns_raw = get_attr("IsOurDNS", "isOurDNS", "is_our_dns", default="false")
-        user_raw = get_attr("User", "user") or API_USER
-        auto_renew = str(auto_renew_raw).lower() == "true"
-        is_expired = str(isexpired_raw).lower() == "true"
-        is_locked = str(islocked_raw).lower() == "true"
-        is_our_dns = str(isourdns_raw).lower() == "true"
-        domain_data_array.append({
-            "AccountId": account_id,
-            "Name": name,
-            "AutoRenew": auto_renew,
-            "Created": format_date(created_raw),
-            "Expires": format_date(expires_raw),
-            "IsExpired": is_expired,
-            "IsLocked": is_locked,
-            "IsOurDNS": is_our_dns,
-            "User": user_raw,
-        })
-    data_to_send = {"accountId": account_id, "domains": domain_data_array}
-    resp = await client.post(
-        f"{SERVER_API_URL}/api/domains/array",
-        json=data_to_send,
-        headers={"Authorization": f"Bearer {SERVER_API_TOKEN}", "Content-Type": "application/json"},
+    domain_data_array = normalize_domains(domains, account_id, default_user=_default_user(target))
+    report_progress("domainsNormalized", len(domain_data_array))
+    await _upload_domains(client, target, account_id, domain_data_array, complete)
+
+
+# bump whenever _fingerprint's encoding changes: stored hashes of another
+# format are dropped (one full upload) instead of all counting as changed
+_FINGERPRINT_FORMAT = 2
+
+
+def _fingerprint(data) -> str:
+    return hashlib.sha1(dumps(data, sort_keys=True)).hexdigest()
+
+
+async def _post_domain_batches(client: httpx.AsyncClient, path: str, account_id, domains: list, removed=None):
+    """Upload `domains` in batches; `removed` rides along with the first one.
+
+    Returns (domains that were accepted, whether `removed` was accepted,
+    [(batch index, error), ...]).
+    """
+    batch_size = UPLOAD_BATCH_SIZE if UPLOAD_BATCH_SIZE > 0 else max(1, len(domains))
+
+    def make_body(index, total, chunk):
+        body = {"accountId": account_id, "domains": chunk}
+        if total > 1:
+            body.update(batchIndex=index, batchCount=total)
+        if removed is not None:
+            body["removed"] = removed if index == 0 else []
+        return body
+
+    sent, failed = await post_in_batches(
+        client,
+        f"{SERVER_API_URL}{path}",
+        {"Authorization": f"Bearer {SERVER_API_TOKEN}"},
+        domains,
+        make_body,
+        batch_size=batch_size,
+        concurrency=UPLOAD_CONCURRENCY,
+        compress=UPLOAD_GZIP,
     )
-    resp.raise_for_status()
+    accepted = []
+    for index in sent:
+        accepted.extend(domains[index * batch_size:(index + 1) * batch_size])
+    return accepted, 0 in sent, failed
 
-def format_date(date_str: Optional[str]):
-    if not date_str:
-        return None
+
+def _raise_batch_failures(failed: list):
+    index, error = failed[0]
+    raise RuntimeError(f"{len(failed)} upload batch(es) failed, first was batch {index}: {error}") from error
+
+
+async def _upload_domains(
+    client: httpx.AsyncClient, target: Target, account_id, domain_data_array: list, complete: bool
+):
+    """Send the domain list, or only what changed since the last upload.
+
+    With DELTA_SYNC the fingerprints of the last uploaded state live in the
+    local StateStore and only added/changed domains and removed names are
+    posted to /api/domains/delta. A full upload still happens every
+    FULL_SYNC_INTERVAL seconds, when there is no local state yet, or when
+    the backend does not know the delta endpoint. Removals are only derived
+    from a complete domain list, never from a partial fetch.
+    """
+    store = target.store if DELTA_SYNC else None
+    fingerprints = {}
+
+    if store is not None:
+        fingerprints, delta = await asyncio.to_thread(
+            _plan_domain_delta, store, account_id, domain_data_array, complete
+        )
+        if delta is not None:
+            changed, removed = delta
+            if not changed and not removed:
+                return
+            accepted, removed_ok, failed = await _post_domain_batches(
+                client, "/api/domains/delta", account_id, changed, removed
+            )
+            missing = any(
+                isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404 for _, e in failed
+            )
+            if not missing:
+                await asyncio.to_thread(
+                    store.update_domains,
+                    account_id,
+                    {d.Name: fingerprints[d.Name] for d in accepted},
+                    removed if removed_ok else [],
+                )
+                if failed:
+                    _raise_batch_failures(failed)
+                return
+            print("Backend has no /api/domains/delta, falling back to a full upload")
+
+    _, _, failed = await _post_domain_batches(client, "/api/domains/array", account_id, domain_data_array)
+    if failed:
+        _raise_batch_failures(failed)
+
+    if store is not None:
+        await asyncio.to_thread(_save_full_upload, store, account_id, fingerprints, complete)
+
+
+def _plan_domain_delta(store, account_id, domain_data_array: list, complete: bool) -> tuple:
+    """Fingerprint the domains and compare them with the last upload.
+
+    Returns (fingerprints, (changed domains, removed names)), or
+    (fingerprints, None) when a full upload is due. Runs in a worker thread.
+    """
+    fingerprints = {d.Name: _fingerprint(d) for d in domain_data_array}
+    current = store.get(f"domains_fingerprint_format:{account_id}") == _FINGERPRINT_FORMAT
+    known = store.domain_fingerprints(account_id) if current else {}
+    full_due = time.time() - store.get(f"domains_full_sync:{account_id}", 0) >= FULL_SYNC_INTERVAL
+    if not known or full_due:
+        return fingerprints, None
+    changed = [d for d in domain_data_array if known.get(d.Name) != fingerprints[d.Name]]
+    removed = [name for name in known if name not in fingerprints] if complete else []
+    return fingerprints, (changed, removed)
+
+
+def _save_full_upload(store, account_id, fingerprints: dict, complete: bool):
+    """Runs in a worker thread."""
+    store.replace_domains(account_id, fingerprints)
+    store.set(f"domains_fingerprint_format:{account_id}", _FINGERPRINT_FORMAT)
+    if complete:
+        store.set(f"domains_full_sync:{account_id}", time.time())
+
+
+def _record_bandwidth(target: Target, bandwidth) -> tuple:
+    """Store the panel snapshot locally and build what update-account sends.
+
+    Returns (bandwidth payload, rows to mark as sent once it was accepted).
+    Runs in a worker thread.
+    """
+    store = target.store
+    if store is None or not isinstance(bandwidth, dict) or "error" in bandwidth:
+        return bandwidth, []
     try:
-        month, day, year = date_str.split('/')
-        return f"{year}-{int(month):02d}-{int(day):02d}"
-    except Exception:
-        return date_str
-
-async def fetch_and_send_info():
-    client = app.state.http_client
-    insecure_client = app.state.insecure_http_client
-    bandwidth = {}
-    info = {"allDomains": [], "balances": {}}
-
-    if PANEL_TYPE == "hestia":
-        bandwidth, _ = await hestia_fetch_all(insecure_client)
-        if DRY_RUN:
-            return "Dry run mode enabled"
-        if not NO_NC:
-            info = await fetch_namecheap(client)
-            if DEBUG:
-                print(info)
-    else:
+        period, totals = snapshot_totals(bandwidth)
+        now = time.time()
+        store.record_bandwidth(now, period, totals, keep_since=now - BANDWIDTH_HISTORY_DAYS * 86400)
+        if not BANDWIDTH_DELTAS:
+            return bandwidth, []
+        return bandwidth_deltas(store.unsent_bandwidth())
+    except Exception as e:
+        print(f"Failed to record bandwidth history: {e}")
+        return bandwidth, []
+
+
+def _domains_complete(info: dict) -> bool:
+    """Whether a NameCheap crawl listed every domain; a crawl that is only
+    partial because getBalances failed still did."""
+    return info.get("status", "success") != "error" and not info.get("failedPages")
+
+
+def _build_domain_index(target: Target, domains: list, complete: bool) -> DomainIndex:
+    previous = target.domain_index
+    generation = previous.generation + 1 if previous else 1
+    records = normalize_domains(domains, None, default_user=_default_user(target))
+    index = DomainIndex(records, generation=generation, complete=complete)
+    store = target.store
+    if store:
         try:
-            bandwidth = await whm_get_bandwidth(insecure_client)
+            store.set("domain_index", index.snapshot())
+            # cheap to poll for, so other workers know when to reload the snapshot
+            store.set("domain_index_version", {"generation": index.generation, "builtAt": index.built_at})
         except Exception as e:
-            bandwidth = {"error": str(e)}
-        if DRY_RUN:
-            return "Dry run mode enabled"
-        if not NO_NC:
-            info = await fetch_namecheap(client)
-            if DEBUG:
-                print(info)
+            print(f"Failed to save domain index snapshot: {e}")
+    return index
+
+
+def _restore_domain_index(target: Target) -> DomainIndex:
+    store = target.store
+    try:
+        saved = store.get("domain_index") if store else None
+        if saved:
+            return DomainIndex.from_snapshot(saved)
+    except Exception as e:
+        print(f"Ignoring unreadable domain index snapshot: {e}")
+    return DomainIndex()
+
+
+async def _run_sync(target: Target):
+    """fetch_and_send_info() with its outcome kept in target.last_sync.
+
+    The last successful run is also saved, so /ready can report it after
+    a restart.
+    """
+    started = time.time()
+    store = target.store
+    try:
+        # counts against the same budget as the scheduled source runs
+        async with app.state.sync_limiter.slot(target.name):
+            result = await fetch_and_send_info(target)
+    except Exception as e:
+        target.last_sync = {"startedAt": started, "finishedAt": time.time(), "ok": False, "error": str(e)}
+        if store:
+            await asyncio.to_thread(store.set, "last_sync_attempt", target.last_sync)
+        raise
+    target.last_sync = {"startedAt": started, "finishedAt": time.time(), "ok": True, "result": result}
+    target.last_successful_sync = target.last_sync
+    if store:
+        await asyncio.to_thread(_save_last_sync, store, target.last_sync)
+    return result
+
+
+def _save_last_sync(store, last_sync: dict):
+    store.set("last_sync_attempt", last_sync)
+    store.set("last_sync", last_sync)
+
+
+async def _follow_shared_state():
+    """Pick up what other workers wrote to the state files: the leader's
+    domain indexes and sync results, and JWKS fetched elsewhere."""
+    while True:
+        await asyncio.sleep(SHARED_STATE_POLL)
+        for target in app.state.targets.values():
+            store = target.store
+            if store is None:
+                continue
+            try:
+                version, last_ok, last = await asyncio.to_thread(
+                    lambda: (store.get("domain_index_version"), store.get("last_sync"), store.get("last_sync_attempt"))
+                )
+                if version and version["builtAt"] != target.domain_index.built_at:
+                    target.domain_index = await asyncio.to_thread(_restore_domain_index, target)
+                    target.domain_index_source = "shared"
+                target.last_successful_sync = last_ok
+                target.last_sync = last or target.last_sync
+            except Exception as e:
+                print(f"Failed to read shared state of target {target.name}: {e}")
+        if CERTS_API_URL:
+            try:
+                _adopt_shared_jwks(await asyncio.to_thread(_load_shared_jwks))
+            except Exception as e:
+                print(f"Failed to read shared JWKS: {e}")
+
+
+async def _fetch_panel(target: Target):
+    client = _client(target.panel)
+    if target.panel == "hestia":
+        bandwidth, _ = await hestia_fetch_all(client, target)
+        return bandwidth
+    try:
+        return await whm_get_bandwidth(client, target)
+    except Exception as e:
+        return {"error": str(e)}
+
+
+# NameCheap account name -> {"task", "balances", "finishedAt"} of its last crawl
+_crawls = {}
+# a scheduled inventory run reuses a crawl of the same account this recent,
+# so targets sharing an account crawl it once per interval between them
+_CRAWL_REUSE = INVENTORY_INTERVAL * (1 - SCHEDULE_JITTER)
+
+
+async def _crawl_namecheap(account: NamecheapAccount, include_balances: bool = True, max_age: float = 0) -> dict:
+    """fetch_namecheap(), shared by the targets that use `account`.
+
+    A crawl in flight is joined, and one that succeeded less than
+    `max_age` seconds ago is reused, as long as it fetched balances
+    whenever they are asked for. Page progress is reported to the job
+    that started the crawl.
+    """
+    entry = _crawls.get(account.name)
+    if entry is not None and (entry["balances"] or not include_balances):
+        task = entry["task"]
+        if not task.done():
+            return await asyncio.shield(task)
+        fresh = not task.cancelled() and time.time() - entry["finishedAt"] < max_age
+        if fresh and task.result().get("status") != "error":
+            return task.result()
+
+    entry = {"balances": include_balances, "finishedAt": None}
+    entry["task"] = asyncio.create_task(
+        fetch_namecheap(_client("namecheap"), account, include_balances=include_balances)
+    )
+    entry["task"].add_done_callback(lambda _: entry.update(finishedAt=time.time()))
+    _crawls[account.name] = entry
+    return await asyncio.shield(entry["task"])
+
+
+# Scheduled sources. Each fetches and pushes only its own slice and returns
+# a fingerprint of it, so the scheduler can stretch the interval while
+# nothing changes.
+
+async def _sync_balances(target: Target):
+    client = _client("backend")
+    balances = await fetch_balances(_client("namecheap"), target.namecheap)
+    if not balances:
+        raise RuntimeError("NameCheap returned no balances")
+    team = await _update_team(client, target)
+    await _resolve_account(client, target, team, {"balances": _balances_slice(balances)})
+    return _fingerprint(balances)
+
+
+async def _sync_bandwidth(target: Target):
+    client = _client("backend")
+    bandwidth = await _fetch_panel(target)
+    if "error" in bandwidth:
+        raise RuntimeError(f"Panel bandwidth unavailable: {bandwidth['error']}")
+    if DRY_RUN:
+        return _fingerprint(bandwidth)
+    payload, sent = await asyncio.to_thread(_record_bandwidth, target, bandwidth)
+    team = await _update_team(client, target)
+    _, _, posted = await _resolve_account(
+        client, target, team, {"bandwidth": {"bandwidth": payload}}, force=bool(sent)
+    )
+    if sent and posted:
+        await asyncio.to_thread(target.store.mark_bandwidth_sent, sent)
+    # equal deltas in a row are still new usage; the rows carry the totals
+    return _fingerprint([payload, sent])
+
+
+async def _sync_inventory(target: Target):
+    # a sync job like /fetch-namecheap-domains: whichever starts first, the
+    # other attaches to it, so the account is never crawled twice at once
+    job, _ = await target.sync_runner.trigger(
+        "inventory", run=functools.partial(_crawl_inventory, target), kind="inventory"
+    )
+    await job.wait()
+    if job.status != "succeeded":
+        raise RuntimeError(job.error)
+    return target.domain_index.fingerprint
+
+
+async def _crawl_inventory(target: Target):
+    async with app.state.sync_limiter.slot(target.name):
+        return await _send_inventory(target)
+
+
+async def _send_inventory(target: Target):
+    client = _client("backend")
+    if target.namecheap is None:
+        info = {"allDomains": [], "status": "success"}
+    else:
+        info = await _crawl_namecheap(target.namecheap, include_balances=False, max_age=_CRAWL_REUSE)
+    if info.get("status") == "error":
+        raise RuntimeError(info.get("message"))
+    domains = info.get("allDomains", [])
+    complete = _domains_complete(info)
+    target.domain_index = await asyncio.to_thread(_build_domain_index, target, domains, complete)
+    target.domain_index_source = "live"
+    team = await _update_team(client, target)
+    account = await _resolve_account(client, target, team, {})
+    await _send_domains(client, target, account, domains, complete, {})
+    return f"Fetched {len(domains)} domains"
 
-    await send_domains_to_server(info.get("allDomains", []), info.get("balances", {}), bandwidth)
-    return f"Fetched {len(info.get('allDomains', []))} domains"
+
+async def fetch_and_send_info(target: Target):
+    """Run one sync cycle as a pipeline of stages.
+
+    The panel collector, the NameCheap crawl and the team update don't
+    depend on each other and run concurrently; the panel snapshot is added
+    to the local bandwidth history, the account update waits for that, the
+    team and the crawl, the domain upload for the account and the crawl.
+    The crawl also replaces the in-memory domain index served by /domains.
+    """
+    client = _client("backend")
+
+    async def fetch_panel(results):
+        return await _fetch_panel(target)
+
+    if DRY_RUN:
+        await fetch_panel(None)
+        return "Dry run mode enabled"
+
+    async def fetch_registrar(results):
+        if target.namecheap is None:
+            return {"allDomains": [], "balances": {}}
+        info = await _crawl_namecheap(target.namecheap)
+        if DEBUG:
+            print(info)
+        return info
+
+    async def index_domains(r):
+        info = r["registrar"]
+        if info.get("status") == "error":
+            return
+        target.domain_index = await asyncio.to_thread(
+            _build_domain_index, target, info.get("allDomains", []), _domains_complete(info)
+        )
+        target.domain_index_source = "live"
+
+    def account_slices(r):
+        slices = {"bandwidth": {"bandwidth": r["bandwidth"][0]}}
+        info = r["registrar"]
+        # don't overwrite the last known balances with zeros
+        if info.get("status") != "error" and not info.get("balancesFailed"):
+            slices["balances"] = _balances_slice(info.get("balances", {}))
+        return slices
+
+    async def send_domains(r):
+        domains = r["registrar"].get("allDomains", [])
+        complete = _domains_complete(r["registrar"])
+        await _send_domains(client, target, r["account"], domains, complete, account_slices(r))
+
+    async def update_account(r):
+        _, sent = r["bandwidth"]
+        account = await _resolve_account(client, target, r["team"], account_slices(r), force=bool(sent))
+        if sent and account[2]:
+            await asyncio.to_thread(target.store.mark_bandwidth_sent, sent)
+        return account
+
+    pipeline = Pipeline()
+    pipeline.add("panel", fetch_panel)
+    pipeline.add("registrar", fetch_registrar)
+    pipeline.add("index", index_domains, "registrar")
+    pipeline.add("bandwidth", lambda r: asyncio.to_thread(_record_bandwidth, target, r["panel"]), "panel")
+    pipeline.add("team", lambda _: _update_team(client, target))
+    pipeline.add("account", update_account, "team", "bandwidth", "registrar")
+    pipeline.add("domains", send_domains, "account", "registrar")
+    set_progress("stages", pipeline.timings)
+    try:
+        results = await pipeline.run()
+    finally:
+        app.state.sync_timings = pipeline.timings
+        if DEBUG:
+            print(f"Sync stage timings: {pipeline.timings}")
+
+    return f"Fetched {len(results['registrar'].get('allDomains', []))} domains"
 
 @app.get("/fetch-namecheap-domains")
-async def fetch_endpoint(request: Request):
-    result = await fetch_and_send_info()
-    return {"result": result}
+async def fetch_endpoint(request: Request, wait: bool = False, target: Optional[str] = None):
+    """Start a full sync, or attach to the one already running. One that
+    arrives during an inventory-only job is queued behind it.
+
+    Answers 202 with the job id right away; `?wait=true` keeps the old
+    behaviour of answering with the result once the sync is done. With
+    TARGETS_FILE, `target` names the target to sync.
+    """
+    job, attached = await _get_target(target).sync_runner.trigger("api")
+    if wait:
+        await job.wait()
+        if job.status != "succeeded":
+            raise HTTPException(status_code=500, detail=f"Sync failed: {job.error}")
+        return {"result": job.result}
+    status_url = f"/sync/jobs/{job.id}"
+    return FastJSONResponse(
+        status_code=202,
+        content={
+            "jobId": job.id,
+            "kind": job.kind,
+            "status": job.status,
+            "attached": attached,
+            "statusUrl": status_url,
+        },
+        headers={"Location": status_url},
+    )
+
+@app.get("/sync/jobs/{job_id}")
+async def sync_job_status(job_id: str, request: Request):
+    for target in request.app.state.targets.values():
+        job = await target.sync_runner.get(job_id)
+        if job is not None:
+            return job.to_dict()
+    raise HTTPException(status_code=404, detail="Unknown sync job")
+
+async def _source_stats(target: Target):
+    """The target's scheduled sources, by source name."""
+    scheduler = getattr(app.state, "scheduler", None)
+    if not scheduler:
+        return None
+    stats = await scheduler.stats(target.sources)
+    return {name[len(target.key):]: s for name, s in stats.items()}
+
+async def _sync_status(target: Target) -> dict:
+    runner = target.sync_runner
+    running = await runner.running()
+    last = await runner.latest()
+    return {
+        "running": running.to_dict() if running else None,
+        "queued": runner.queued.to_dict() if runner.queued else None,
+        "last": last.to_dict() if last else None,
+        "lastSuccessfulSync": target.last_successful_sync,
+        "sources": await _source_stats(target),
+    }
+
+@app.get("/sync/status")
+async def sync_status(request: Request, target: Optional[str] = None):
+    """Sync state of `target`, or of every target under "targets" when
+    TARGETS_FILE lists several and none is given."""
+    targets = request.app.state.targets
+    if target is None and len(targets) > 1:
+        body = {"targets": {name: await _sync_status(t) for name, t in targets.items()}}
+    else:
+        body = await _sync_status(_get_target(target))
+    return {
+        **body,
+        "worker": request.app.state.leader.holder,
+        "leader": request.app.state.leader.is_leader,
+        "slots": request.app.state.sync_limiter.stats(),
+    }
+
+async def _target_readiness(target: Target, now: float) -> dict:
+    index = target.domain_index
+    last_sync = target.last_sync
+    last_ok = target.last_successful_sync
+
+    def age(ts):
+        return round(now - ts, 1) if ts else None
+
+    sources = await _source_stats(target)
+    if sources:
+        # a source is overdue once it missed two of its longest intervals
+        stale = any(
+            not s["lastSuccess"] or now - s["lastSuccess"] > 2 * s["interval"] * SCHEDULE_MAX_FACTOR
+            for s in sources.values()
+        )
+    else:
+        stale = not last_ok or now - last_ok["finishedAt"] > 2 * SYNC_INTERVAL
+
+    return {
+        "ready": index.generation > 0 or last_ok is not None,
+        "domains": {
+            "source": target.domain_index_source,
+            "generation": index.generation,
+            "count": len(index),
+            "complete": index.complete,
+            "ageSeconds": age(index.built_at) if index.generation else None,
+        },
+        "lastSync": last_sync and {**last_sync, "ageSeconds": age(last_sync["finishedAt"])},
+        "lastSuccessfulSync": last_ok and {**last_ok, "ageSeconds": age(last_ok["finishedAt"])},
+        "stale": stale,
+        "sources": sources,
+    }
+
+@app.get("/ready")
+async def readiness(request: Request):
+    """Ready once there is domain data to serve (restored or live) for
+    every target and, with CERTS_API_URL, keys to verify tokens with.
+    Reports data age; several targets are reported under "targets"."""
+    now = time.time()
+    targets = {name: await _target_readiness(t, now) for name, t in request.app.state.targets.items()}
+    if len(targets) == 1:
+        body = next(iter(targets.values()))
+    else:
+        body = {
+            "ready": all(t["ready"] for t in targets.values()),
+            "stale": any(t["stale"] for t in targets.values()),
+            "targets": targets,
+        }
+    body["ready"] = body["ready"] and (not CERTS_API_URL or bool(_jwks_keys))
+    jwks_age = round(now - _jwks_fetched_at, 1) if _jwks_fetched_at else None
+    body["jwks"] = {"keys": len(_jwks_keys), "ageSeconds": jwks_age} if CERTS_API_URL else None
+    body["leader"] = request.app.state.leader.is_leader
+    return FastJSONResponse(content=body, status_code=200 if body["ready"] else 503)
+
+@app.get("/domains")
+async def get_domains(
+    request: Request,
+    name: Optional[str] = None,
+    prefix: Optional[str] = None,
+    user: Optional[str] = None,
+    expires_after: Optional[str] = None,
+    expires_before: Optional[str] = None,
+    expires_within: Optional[int] = None,
+    expired: Optional[bool] = None,
+    auto_renew: Optional[bool] = None,
+    sort: str = "name",
+    offset: int = 0,
+    limit: int = 100,
+    target: Optional[str] = None,
+):
+    """Query the domains of the last NameCheap sync from the in-memory index.
+
+    Dates are YYYY-MM-DD; `expires_within=N` means from today to N days
+    ahead. The ETag changes with every sync, not with the query.
+    """
+    index = _get_target(target).domain_index
+    if not index.generation:
+        raise HTTPException(status_code=409, detail="No synced domains yet")
+    if sort not in ("name", "expires"):
+        raise HTTPException(status_code=400, detail="Invalid request: sort must be name or expires")
+    if _etag_matches(request.headers.get("if-none-match"), index.etag):
+        return Response(status_code=304, headers={"ETag": index.etag})
+
+    if expires_within is not None:
+        today = date.today()
+        expires_after = max(expires_after or "", today.isoformat())
+        expires_before = min(expires_before or "9999-12-31", (today + timedelta(days=expires_within)).isoformat())
+    offset = max(0, offset)
+    limit = max(0, min(limit, 1000))
+    total, domains = index.query(
+        name=name,
+        prefix=prefix,
+        user=user,
+        expires_after=expires_after,
+        expires_before=expires_before,
+        expired=expired,
+        auto_renew=auto_renew,
+        sort=sort,
+        offset=offset,
+        limit=limit,
+    )
+    return FastJSONResponse(
+        content={
+            "generation": index.generation,
+            "syncedAt": index.built_at,
+            "complete": index.complete,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "domains": domains,
+        },
+        headers={"ETag": index.etag},
+    )
+
+@app.get("/bandwidth")
+async def get_bandwidth_history(
+    user: Optional[str] = None,
+    domain: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 1000,
+    top: Optional[int] = None,
+    by: str = "account",
+    period: Optional[str] = None,
+    target: Optional[str] = None,
+):
+    """Bandwidth history or top-N from the local store; never calls the panel.
+
+    `since` / `until` are unix timestamps. With `top`, the biggest accounts
+    (or domains with by=domain) of `period` (default: the latest) are returned.
+    """
+    store = _get_target(target).store
+    if store is None:
+        raise HTTPException(status_code=503, detail="Local state store unavailable")
+    if by not in ("account", "domain"):
+        raise HTTPException(status_code=400, detail="Invalid request: by must be account or domain")
+
+    if top is not None:
+        if period is None:
+            periods = await asyncio.to_thread(store.bandwidth_periods)
+            period = periods[0] if periods else None
+        rows = await asyncio.to_thread(store.top_bandwidth, period, max(0, top), by, user) if period else []
+        return {"period": period, "by": by, "top": rows}
+
+    samples = await asyncio.to_thread(
+        store.bandwidth_history, user, domain, since, until, max(0, min(limit, 10000))
+    )
+    return {"samples": samples, "count": len(samples)}
+
+@app.get("/stats/http")
+async def http_stats(request: Request):
+    """Connection pool usage per upstream: active and idle connections,
+    requests waiting for one, and how long they waited."""
+    return request.app.state.clients.stats()
+
+@app.get("/stats/namecheap")
+async def namecheap_stats(request: Request):
+    """Request scheduler stats of the NameCheap account, or of every
+    account under "accounts" when TARGETS_FILE configures several."""
+    accounts = {}
+    for target in request.app.state.targets.values():
+        if target.namecheap is not None:
+            accounts[target.namecheap.name] = target.namecheap.scheduler.stats()
+    cache_stats = await dns_cache.stats()
+    if len(accounts) == 1:
+        return {**next(iter(accounts.values())), "dns_cache": cache_stats}
+    return {"accounts": accounts, "dns_cache": cache_stats}
 
 class DNSRecord(BaseModel):
     name: str
@@ -297,76 +1239,313 @@ class DNSRecord(BaseModel):
 class DNSRecordsUpdate(BaseModel):
     records: List[DNSRecord]
 
+class DNSDomainUpdate(BaseModel):
+    domain: str
+    records: List[DNSRecord]
+
+class DNSBatchUpdate(BaseModel):
+    updates: List[DNSDomainUpdate]
+
+class DNSBulkRequest(BaseModel):
+    domains: List[str] = []
+    all: bool = False
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+def _registrar_for(domain: str, target: Optional[str]) -> NamecheapAccount:
+    """The NameCheap account to manage `domain` with: that of `target`, of
+    the only target, or of the target whose last sync listed the domain.
+
+    Raises LookupError when there is none.
+    """
+    targets = app.state.targets
+    if target is not None or len(targets) == 1:
+        found = _find_target(target)
+        if found is None:
+            raise LookupError(f"Unknown target {target}")
+    else:
+        name = normalize_domain(domain)
+        found = next((t for t in targets.values() if t.domain_index.get(name)), None)
+        if found is None:
+            raise LookupError(f"{name} is not among the synced domains of any target, pass ?target=")
+    if found.namecheap is None:
+        raise LookupError(f"Target {found.name} has no NameCheap account")
+    return found.namecheap
+
 @app.get("/dns-records/{domain}")
-async def get_dns_records(domain: str, request: Request):
+async def get_dns_records(domain: str, request: Request, target: Optional[str] = None):
     try:
-        client = request.app.state.http_client
-        records = await fetch_domain_dns_records(client, domain)
-        return {
+        client = _client("namecheap")
+        account = _registrar_for(domain, target)
+        records, etag = await dns_cache.get(domain, lambda d: fetch_domain_dns_records(client, account, d))
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch DNS records: {str(e)}")
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return FastJSONResponse(
+        content={
             "domain": domain,
             "records": records,
             "count": len(records)
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to fetch DNS records: {str(e)}")
+        },
+        headers={"ETag": etag},
+    )
+
+async def _stream_dns_records(client: httpx.AsyncClient, domains, target: Optional[str] = None):
+    """Yield one NDJSON line per domain, in completion order.
+
+    A fixed set of workers pulls domains from the iterator, so memory use
+    does not grow with the number of domains requested.
+    """
+    concurrency = max(1, BULK_DNS_CONCURRENCY)
+    pending = iter(domains)
+    lines = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        for domain in pending:
+            try:
+                account = _registrar_for(domain, target)
+                records, _ = await dns_cache.get(
+                    domain, lambda d: fetch_domain_dns_records(client, account, d, priority=BULK)
+                )
+                line = {"domain": domain, "records": records, "count": len(records)}
+            except Exception as e:
+                line = {"domain": domain, "error": str(e)}
+            await lines.put(dumps(line) + b"\n")
+        await lines.put(None)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        running = len(workers)
+        while running:
+            line = await lines.get()
+            if line is None:
+                running -= 1
+                continue
+            yield line
+    finally:
+        for task in workers:
+            task.cancel()
+
+@app.post("/dns-records/bulk")
+async def get_dns_records_bulk(query: DNSBulkRequest, request: Request, target: Optional[str] = None):
+    if query.all:
+        if target is None:
+            targets = request.app.state.targets.values()
+        else:
+            targets = [_get_target(target)]
+        domains = [name for t in targets for name in t.domain_index.names()]
+        if not domains:
+            raise HTTPException(status_code=409, detail="No synced domains yet")
+    else:
+        domains = query.domains
+    if not domains:
+        raise HTTPException(status_code=400, detail="Invalid request: no domains given")
+    return StreamingResponse(
+        _stream_dns_records(_client("namecheap"), domains, target),
+        media_type="application/x-ndjson",
+    )
 
 @app.put("/dns-records/{domain}")
-async def update_dns_records(domain: str, update_data: DNSRecordsUpdate, request: Request):
+async def update_dns_records(
+    domain: str, update_data: DNSRecordsUpdate, request: Request, target: Optional[str] = None
+):
     try:
-        client = request.app.state.http_client
+        client = _client("namecheap")
         records_data = [record.dict() for record in update_data.records]
-        result = await set_domain_dns_records(client, domain, records_data)
+        account = _registrar_for(domain, target)
+        result = await set_domain_dns_records(client, account, domain, records_data)
+        await dns_cache.invalidate(domain)
         return {
             "domain": result.get("domain"),
             "success": result.get("success"),
             "records_count": len(records_data)
         }
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Invalid request: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update DNS records: {str(e)}")
 
 
-@app.on_event("startup")
-async def startup_event():
-    app.state.http_client = httpx.AsyncClient(
-        timeout=10,
-        verify=True,
-        limits=httpx.Limits(
-            max_connections=50,
-            max_keepalive_connections=10,
-        ),
+async def _patch_dns_records(
+    client: httpx.AsyncClient, account: NamecheapAccount, domain: str, records: list, priority: int
+) -> dict:
+    """Write `records` only if they differ from the live (or cached) zone."""
+    current, _ = await dns_cache.get(
+        domain, lambda d: fetch_domain_dns_records(client, account, d, priority=priority)
     )
+    diff = diff_dns_records(current, records)
+    changed = any(diff.values())
+    if changed:
+        await set_domain_dns_records(client, account, domain, records, priority=priority)
+        await dns_cache.invalidate(domain)
+    return {"domain": normalize_domain(domain), "changed": changed, "diff": diff}
 
-    app.state.insecure_http_client = httpx.AsyncClient(
-        timeout=10,
-        verify=False,
-        limits=httpx.Limits(
-            max_connections=20,
-            max_keepalive_connections=5,
-        ),
-    )
+@app.patch("/dns-records")
+async def patch_dns_records_batch(batch: DNSBatchUpdate, request: Request, target: Optional[str] = None):
+    client = _client("namecheap")
+    sem = asyncio.Semaphore(max(1, BULK_DNS_CONCURRENCY))
+
+    async def apply(update: DNSDomainUpdate):
+        records_data = [record.dict() for record in update.records]
+        try:
+            account = _registrar_for(update.domain, target)
+            async with sem:
+                return await _patch_dns_records(client, account, update.domain, records_data, BULK)
+        except Exception as e:
+            return {"domain": update.domain, "error": str(e)}
+
+    results = await asyncio.gather(*[apply(update) for update in batch.updates])
+    return {
+        "results": results,
+        "changed": sum(1 for r in results if r.get("changed")),
+        "failed": sum(1 for r in results if "error" in r),
+    }
 
+@app.patch("/dns-records/{domain}")
+async def patch_dns_records(
+    domain: str, update_data: DNSRecordsUpdate, request: Request, target: Optional[str] = None
+):
     try:
-        await fetch_and_send_info()
+        client = _client("namecheap")
+        records_data = [record.dict() for record in update_data.records]
+        account = _registrar_for(domain, target)
+        return await _patch_dns_records(client, account, domain, records_data, INTERACTIVE)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request: {str(e)}")
     except Exception as e:
-        print(f"Startup fetch failed (will retry in loop): {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to update DNS records: {str(e)}")
 
-    async def loop():
-        while True:
-            try:
-                await fetch_and_send_info()
-            except Exception as e:
-                print(f"Error in cron fetch: {str(e)}")
-            await asyncio.sleep(6 * 60 * 60)
 
-    asyncio.create_task(loop())
+@app.on_event("startup")
+async def startup_event():
+    try:
+        app.state.state_store = StateStore(STATE_DB)
+    except Exception as e:
+        print(f"Local state store {STATE_DB} unavailable, state will not persist: {e}")
+        app.state.state_store = None
+
+    targets, options = _load_targets()
+    app.state.targets = {target.name: target for target in targets}
+    worker = process_id()
+    for target in targets:
+        target.store = _target_store(target)
+        _load_identity(target)
+        # serve the last known data right away; the first live sync runs in the background
+        target.domain_index = await asyncio.to_thread(_restore_domain_index, target)
+        target.domain_index_source = "snapshot" if target.domain_index.generation else None
+        if target.store:
+            target.last_successful_sync = target.store.get("last_sync")
+        target.sync_runner = SyncRunner(
+            functools.partial(_run_sync, target), store=target.store, holder=worker, lease_ttl=LEADER_LEASE_TTL
+        )
+    if CERTS_API_URL:
+        _adopt_shared_jwks(_load_shared_jwks())
+    dns_cache.store = app.state.state_store
+    # NameCheap counts its limits per API user, across all worker processes
+    for target in targets:
+        if target.namecheap is not None:
+            target.namecheap.scheduler.store = app.state.state_store
+            target.namecheap.scheduler.name = f"namecheap:{target.namecheap.api_user}"
+
+    app.state.clients = _build_clients(options.get("http", {}))
+
+    if CERTS_API_URL:
+        app.state.jwks_refresh_task = asyncio.create_task(_jwks_refresh_loop(_client("jwks")))
+
+    store = app.state.state_store
+    app.state.leader = LeaderElector(store, ttl=LEADER_LEASE_TTL, holder=worker)
+    # shared by the sources of all targets, handed out to targets in turn
+    app.state.sync_limiter = FairLimiter(int(options.get("concurrency", SYNC_CONCURRENCY)))
+    app.state.background_tasks = [asyncio.create_task(app.state.leader.run())]
+    if store:
+        app.state.background_tasks.append(asyncio.create_task(_follow_shared_state()))
+
+    app.state.scheduler = None
+
+    async def start_scheduler():
+        # the worker that is leader at startup syncs every source right
+        # away; one that takes over later keeps to the saved schedules
+        await app.state.leader.decided.wait()
+        scheduler = SourceScheduler(
+            store, app.state.leader, idle_check=LEADER_LEASE_TTL / 3, limiter=app.state.sync_limiter
+        )
+        for target in targets:
+            sources = [
+                ("balances", _sync_balances, BALANCES_INTERVAL, target.namecheap is not None and not DRY_RUN),
+                ("bandwidth", _sync_bandwidth, BANDWIDTH_INTERVAL, True),
+                ("inventory", _sync_inventory, INVENTORY_INTERVAL, not DRY_RUN),
+            ]
+            for source, fn, interval, enabled in sources:
+                if not enabled:
+                    continue
+                name = f"{target.key}{source}"
+                schedule = SourceSchedule(
+                    name, interval, max_factor=SCHEDULE_MAX_FACTOR, jitter=SCHEDULE_JITTER, retry_min=SCHEDULE_RETRY_MIN
+                )
+                await scheduler.add(
+                    name,
+                    functools.partial(fn, target),
+                    schedule,
+                    run_now=app.state.leader.is_leader,
+                    group=target.name,
+                    # the inventory crawl takes its slot inside its sync job
+                    limit=source != "inventory",
+                )
+                target.sources.append(name)
+        scheduler.start()
+        app.state.scheduler = scheduler
+
+    app.state.background_tasks.append(asyncio.create_task(start_scheduler()))
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    await app.state.http_client.aclose()
-    await app.state.insecure_http_client.aclose()
+    # stop everything that could still use a client or a store, then wait
+    # for it to finish before those are closed
+    tasks = list(getattr(app.state, "background_tasks", []))
+    if getattr(app.state, "jwks_refresh_task", None):
+        tasks.append(app.state.jwks_refresh_task)
+    tasks.extend(entry["task"] for entry in _crawls.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    if getattr(app.state, "scheduler", None):
+        await app.state.scheduler.shutdown()
+    targets = getattr(app.state, "targets", {}).values()
+    # interrupted jobs are recorded as failed and give up the run lease
+    await asyncio.gather(
+        *[t.sync_runner.shutdown() for t in targets if t.sync_runner is not None], return_exceptions=True
+    )
+    if getattr(app.state, "leader", None):
+        # let another worker take over now instead of after the lease runs out
+        try:
+            await app.state.leader.release()
+        except Exception as e:
+            print(f"Failed to release the leader lease: {e}")
+
+    if getattr(app.state, "clients", None):
+        await app.state.clients.aclose()
+    for target in targets:
+        if target.store is not None and target.store is not app.state.state_store:
+            target.store.close()
+    if getattr(app.state, "state_store", None):
+        app.state.state_store.close()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,228 @@
+import os
+import json
+import heapq
+from datetime import datetime, timezone
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# How much per-domain usage is kept for each account:
+#   "full" every bwusage entry, "top" the BANDWIDTH_TOP_DOMAINS biggest, "none" no entries
+BANDWIDTH_DETAIL = os.getenv("BANDWIDTH_DETAIL", "full").lower()
+BANDWIDTH_TOP_DOMAINS = int(os.getenv("BANDWIDTH_TOP_DOMAINS", 10))
+
+_ACCT_ITEM = "data.acct.item"
+_BWUSAGE = "data.acct.item.bwusage"
+_BWUSAGE_ITEM = "data.acct.item.bwusage.item"
+
+
+def _usage(entry: dict) -> int:
+    try:
+        return int(float(entry.get("usage") or 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def compact_account(acct: dict) -> dict:
+    """Trim one showbw account to the configured per-domain detail."""
+    bwusage = acct.get("bwusage") or []
+    if BANDWIDTH_DETAIL == "none":
+        bwusage = []
+    elif BANDWIDTH_DETAIL == "top" and len(bwusage) > BANDWIDTH_TOP_DOMAINS:
+        bwusage = heapq.nlargest(BANDWIDTH_TOP_DOMAINS, bwusage, key=_usage)
+    result = dict(acct)
+    result["bwusage"] = bwusage
+    try:
+        result["totalbytes"] = int(float(acct.get("totalbytes") or 0))
+    except (TypeError, ValueError):
+        pass
+    return result
+
+
+def compact_showbw(bandwidth: dict) -> dict:
+    """Apply compact_account to every account of a showbw-shaped dict."""
+    data = bandwidth.get("data") if isinstance(bandwidth, dict) else None
+    if not isinstance(data, dict) or not isinstance(data.get("acct"), list):
+        return bandwidth
+    return {**bandwidth, "data": {**data, "acct": [compact_account(a) for a in data["acct"]]}}
+
+
+def snapshot_totals(bandwidth: dict, now=None) -> tuple[str, dict]:
+    """Flatten a (compact) showbw dict to ("YYYY-MM", {(user, domain): bytes}).
+
+    domain "" holds the account's totalbytes; per-domain series follow
+    whatever BANDWIDTH_DETAIL kept.
+    """
+    data = bandwidth.get("data") or {}
+    now = now or datetime.now(timezone.utc)
+    try:
+        period = f"{int(data['year']):04d}-{int(data['month']):02d}"
+    except (KeyError, TypeError, ValueError):
+        period = f"{now.year:04d}-{now.month:02d}"
+    totals = {}
+    for account in data.get("acct") or []:
+        user = account.get("user")
+        if not user:
+            continue
+        totals[(user, "")] = _usage({"usage": account.get("totalbytes")})
+        for entry in account.get("bwusage") or []:
+            if entry.get("domain"):
+                totals[(user, entry["domain"])] = _usage(entry)
+    return period, totals
+
+
+def bandwidth_deltas(unsent: list[tuple]) -> tuple[dict, list[tuple]]:
+    """Turn StateStore.unsent_bandwidth() rows into the delta payload.
+
+    Returns (payload, rows to pass to mark_bandwidth_sent once the backend
+    accepted it). A total that went down (an account re-created within the
+    month) counts from zero again.
+    """
+    accounts = {}
+    sent = []
+    for period, user, domain, value, sent_bytes in unsent:
+        delta = value - sent_bytes if value >= sent_bytes else value
+        account = accounts.get((period, user))
+        if account is None:
+            account = accounts[(period, user)] = {"period": period, "user": user, "bytes": 0, "domains": []}
+        if domain:
+            account["domains"].append({"domain": domain, "bytes": delta})
+        else:
+            account["bytes"] = delta
+        sent.append((period, user, domain, value))
+    return {"format": "delta", "accounts": list(accounts.values())}, sent
+
+
+class _AsyncReader:
+    """Adapts an async byte iterator to the read(n) interface ijson expects."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._buffer = b""
+
+    async def read(self, n: int = -1) -> bytes:
+        # ijson probes with read(0) to tell bytes from str; that must not consume a chunk
+        if n == 0:
+            return b""
+        if not self._buffer:
+            try:
+                self._buffer = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                return b""
+        if n < 0:
+            n = len(self._buffer)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+
+async def parse_showbw(chunks) -> dict:
+    """Build the compact showbw dict from an async iterator of body chunks.
+
+    With BANDWIDTH_DETAIL=top/none the bwusage entries are trimmed while
+    the body is read, so a large server's per-domain list is never held in
+    memory. With "full" (the default) or without ijson nothing would be
+    dropped, and the whole body is collected and parsed with the json
+    module, which is faster. Both ways return the same dict.
+    """
+    if ijson is None or BANDWIDTH_DETAIL == "full":
+        body = b"".join([chunk async for chunk in chunks])
+        return compact_showbw(json.loads(body))
+
+    keep_top = BANDWIDTH_DETAIL == "top"
+    # everything outside the accounts, in the shape json.loads gives it;
+    # data.acct is left empty there and filled with the compacted accounts
+    document = ijson.ObjectBuilder()
+    acct = []
+    builder = None
+    top = []
+    entry = None
+    seq = 0
+    async for prefix, event, value in ijson.parse_async(_AsyncReader(chunks), use_float=True):
+        if builder is not None:
+            if prefix.startswith(_BWUSAGE):
+                if not keep_top:
+                    continue
+                if prefix == _BWUSAGE_ITEM:
+                    if event == "start_map":
+                        entry = {}
+                    elif event == "end_map":
+                        seq += 1
+                        item = (_usage(entry), -seq, entry)
+                        if len(top) < BANDWIDTH_TOP_DOMAINS:
+                            heapq.heappush(top, item)
+                        elif BANDWIDTH_TOP_DOMAINS > 0:
+                            heapq.heappushpop(top, item)
+                        entry = None
+                elif entry is not None and event not in ("map_key", "start_map", "end_map", "start_array", "end_array"):
+                    entry[prefix[len(_BWUSAGE_ITEM) + 1:]] = value
+                continue
+            builder.event(event, value)
+            if prefix == _ACCT_ITEM and event == "end_map":
+                account = builder.value
+                account["bwusage"] = [e for _, _, e in sorted(top, reverse=True)]
+                acct.append(compact_account(account))
+                builder = None
+                top = []
+        elif prefix == _ACCT_ITEM and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        else:
+            document.event(event, value)
+
+    result = document.value
+    data = result.get("data") if isinstance(result, dict) else None
+    if isinstance(data, dict) and isinstance(data.get("acct"), list):
+        data["acct"] = acct
+    return result
+
+if __name__ == "__main__":
+    import time
+    import random
+    import asyncio
+    import tracemalloc
+
+    showbw = {
+        "metadata": {"result": 1, "version": 1, "command": "showbw", "reason": "OK"},
+        "data": {
+            "reseller": "root",
+            "month": 1,
+            "year": 2024,
+            "totalused": "0",
+            "acct": [
+                {
+                    "user": f"user{u}", "maindomain": f"site{u}.example", "owner": "root", "limit": 0,
+                    "reseller": 0, "deleted": 0, "bwlimited": 0, "totalbytes": str(random.randint(0, 10 ** 10)),
+                    "bwusage": [
+                        {"domain": f"d{u}-{d}.example", "usage": str(random.randint(0, 10 ** 8)), "deleted": 0}
+                        for d in range(50)
+                    ],
+                }
+                for u in range(2000)
+            ],
+        },
+    }
+    body = json.dumps(showbw).encode()
+
+    async def _chunks():
+        for i in range(0, len(body), 64 * 1024):
+            yield body[i:i + 64 * 1024]
+
+    def _whole():
+        return compact_showbw(json.loads(body))
+
+    def _stream():
+        return asyncio.run(parse_showbw(_chunks()))
+
+    assert _whole() == _stream()
+    print(f"showbw {len(body) / 1024:.0f} KiB, detail={BANDWIDTH_DETAIL}, ijson={'yes' if ijson else 'no'}")
+    for label, fn in (("json.loads", _whole), ("stream", _stream)):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t0
+        tracemalloc.start()
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:<12} {elapsed * 1000:8.1f} ms  peak {peak / 1024:9.1f} KiB  output {len(json.dumps(result)) / 1024:8.0f} KiB")
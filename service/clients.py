@@ -0,0 +1,168 @@
+import os
+import time
+import importlib.util
+from dataclasses import dataclass
+import httpx
+
+_HAS_H2 = importlib.util.find_spec("h2") is not None
+
+
+@dataclass
+class UpstreamSettings:
+    """Pool and timeout settings of one upstream's HTTP client."""
+
+    max_connections: int = 10
+    max_keepalive: int = 5
+    keepalive_expiry: float = 30
+    timeout: float = 10
+    # how long a request may wait for a free connection before PoolTimeout
+    pool_timeout: float = 30
+    http2: bool = False
+    verify: bool = True
+
+    def with_env(self, name: str) -> "UpstreamSettings":
+        """These defaults overridden by HTTP_<NAME>_MAX_CONNECTIONS,
+        _MAX_KEEPALIVE, _KEEPALIVE_EXPIRY, _TIMEOUT, _POOL_TIMEOUT and _HTTP2."""
+        prefix = f"HTTP_{name.upper()}_"
+        return UpstreamSettings(
+            max_connections=int(os.getenv(prefix + "MAX_CONNECTIONS", self.max_connections)),
+            max_keepalive=int(os.getenv(prefix + "MAX_KEEPALIVE", self.max_keepalive)),
+            keepalive_expiry=float(os.getenv(prefix + "KEEPALIVE_EXPIRY", self.keepalive_expiry)),
+            timeout=float(os.getenv(prefix + "TIMEOUT", self.timeout)),
+            pool_timeout=float(os.getenv(prefix + "POOL_TIMEOUT", self.pool_timeout)),
+            http2=os.getenv(prefix + "HTTP2", str(self.http2)).lower() == "true",
+            verify=self.verify,
+        )
+
+
+class PoolStats:
+    def __init__(self):
+        self.requests = 0
+        self.waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.acquired = 0
+        self.pool_timeouts = 0
+
+    def waited(self, seconds: float):
+        self.acquired += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+
+class _MeteredTransport(httpx.AsyncHTTPTransport):
+    """AsyncHTTPTransport that measures how long requests wait for a
+    connection from the pool.
+
+    httpcore reports nothing while a request waits in the pool; the first
+    trace event it emits (connecting, or sending headers on a reused
+    connection) marks the moment the request got its connection.
+    """
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stats = self.stats
+        started = time.monotonic()
+        acquired = False
+        outer = request.extensions.get("trace")
+
+        async def trace(name, info):
+            nonlocal acquired
+            if not acquired:
+                acquired = True
+                stats.waiting -= 1
+                stats.waited(time.monotonic() - started)
+            if outer is not None:
+                await outer(name, info)
+
+        stats.requests += 1
+        stats.waiting += 1
+        request.extensions = {**request.extensions, "trace": trace}
+        try:
+            return await super().handle_async_request(request)
+        except httpx.PoolTimeout:
+            stats.pool_timeouts += 1
+            raise
+        finally:
+            if not acquired:
+                stats.waiting -= 1
+
+    def connections(self) -> list:
+        return self._pool.connections
+
+
+class ClientRegistry:
+    """One httpx.AsyncClient per upstream, each with its own connection
+    pool, timeouts and HTTP version, so a slow upstream can only use up
+    its own connections.
+
+    HTTP/2 needs the `h2` package; without it clients asking for it fall
+    back to HTTP/1.1.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._transports = {}
+        self._settings = {}
+
+    def add(self, name: str, settings: UpstreamSettings) -> httpx.AsyncClient:
+        http2 = settings.http2
+        if http2 and not _HAS_H2:
+            print(f"HTTP/2 requested for {name} but the h2 package is not installed, using HTTP/1.1")
+            http2 = False
+        transport = _MeteredTransport(
+            PoolStats(),
+            verify=settings.verify,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=settings.max_connections,
+                max_keepalive_connections=settings.max_keepalive,
+                keepalive_expiry=settings.keepalive_expiry,
+            ),
+        )
+        client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(settings.timeout, pool=settings.pool_timeout),
+        )
+        self._clients[name] = client
+        self._transports[name] = transport
+        self._settings[name] = (settings, http2)
+        return client
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        return self._clients[name]
+
+    def stats(self) -> dict:
+        result = {}
+        for name, transport in self._transports.items():
+            settings, http2 = self._settings[name]
+            stats = transport.stats
+            active = idle = 0
+            for connection in transport.connections():
+                if connection.is_closed():
+                    continue
+                if connection.is_idle():
+                    idle += 1
+                else:
+                    active += 1
+            result[name] = {
+                "max_connections": settings.max_connections,
+                "max_keepalive": settings.max_keepalive,
+                "timeout_seconds": settings.timeout,
+                "http2": http2,
+                "active": active,
+                "idle": idle,
+                "waiting": stats.waiting,
+                "requests": stats.requests,
+                "avg_wait_seconds": round(stats.wait_total / stats.acquired, 4) if stats.acquired else 0.0,
+                "max_wait_seconds": round(stats.wait_max, 4),
+                "pool_timeouts": stats.pool_timeouts,
+            }
+        return result
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
@@ -0,0 +1,108 @@
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from service.namecheap import normalize_domain
+
+
+def records_etag(records: list) -> str:
+    digest = hashlib.sha1(json.dumps(records, sort_keys=True, default=str).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+class DNSCache:
+    """TTL + LRU cache of DNS host records, keyed on the normalized domain.
+
+    Concurrent misses for the same domain share one upstream call. A load
+    that was started before `invalidate` is not stored afterwards, so a
+    write can't be undone by a read that raced it.
+
+    With a `store` (StateStore) set, entries live in its SQLite file instead
+    of process memory, so every worker process sees the same entries and
+    invalidations; eviction is then by expiry rather than LRU.
+    """
+
+    def __init__(self, ttl: float = 300, max_size: int = 1000, store=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.store = store
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._generation = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def _lookup(self, key: str):
+        if self.store is not None:
+            return await asyncio.to_thread(self.store.dns_cache_get, key)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def put(self, domain: str, records: list, loaded_since: float = None) -> str:
+        key = normalize_domain(domain)
+        etag = records_etag(records)
+        if self.store is not None:
+            if self.ttl > 0 and self.max_size > 0:
+                since = time.time() if loaded_since is None else loaded_since
+                await asyncio.to_thread(
+                    self.store.dns_cache_put, key, records, etag, self.ttl, since, self.max_size
+                )
+        elif self.ttl > 0 and self.max_size > 0:
+            self._entries[key] = (records, etag, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return etag
+
+    async def invalidate(self, domain: str):
+        key = normalize_domain(domain)
+        self._entries.pop(key, None)
+        self._generation[key] = self._generation.get(key, 0) + 1
+        if self.store is not None:
+            await asyncio.to_thread(self.store.dns_cache_invalidate, key)
+
+    async def get(self, domain: str, loader) -> tuple[list, str]:
+        """Returns (records, etag), calling `loader(domain)` on a miss."""
+        key = normalize_domain(domain)
+        entry = await self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[0], entry[1]
+
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str, loader) -> tuple[list, str]:
+        generation = self._generation.get(key, 0)
+        started = time.time()
+        records = await loader(key)
+        if self._generation.get(key, 0) == generation:
+            return records, await self.put(key, records, loaded_since=started)
+        return records, records_etag(records)
+
+    async def stats(self) -> dict:
+        if self.store is not None:
+            entries = await asyncio.to_thread(self.store.dns_cache_count)
+        else:
+            entries = len(self._entries)
+        return {
+            "entries": entries,
+            "shared": self.store is not None,
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "inflight": len(self._inflight),
+        }
@@ -0,0 +1,177 @@
+import json
+import time
+import hashlib
+from bisect import bisect_left, bisect_right
+from typing import Optional
+from service.normalize import DomainRecord
+
+
+def _public(record: DomainRecord) -> dict:
+    item = record.to_dict()
+    del item["AccountId"]
+    return item
+
+
+class DomainIndex:
+    """Read-only lookup structure over one sync's normalized domains.
+
+    Records are kept sorted by name, so a name prefix is a bisect range;
+    exact names and users are dict lookups and expiry ranges are a bisect
+    range over a second array sorted by Expires ("YYYY-MM-DD" strings sort
+    like dates). Every rebuild is a new instance with the next
+    `generation`; queries never see a half-built index.
+    """
+
+    def __init__(
+        self, records: list[DomainRecord] = (), generation: int = 0, complete: bool = True, built_at: float = None
+    ):
+        self.generation = generation
+        self.complete = complete
+        self.built_at = built_at or time.time()
+        self._records = sorted(records, key=lambda r: r.Name.lower())
+        self._names = [r.Name.lower() for r in self._records]
+        self._by_name = dict(zip(self._names, self._records))
+        self._by_user = {}
+        for record in self._records:
+            self._by_user.setdefault(record.User, []).append(record)
+        self._by_expiry = sorted((r for r in self._records if r.Expires), key=lambda r: r.Expires)
+        self._expiry_keys = [r.Expires for r in self._by_expiry]
+        self._expiry_order = self._by_expiry + [r for r in self._records if not r.Expires]
+        self.etag = f'"{generation}.{int(self.built_at * 1000)}"'
+        self._fingerprint = None
+
+    def snapshot(self) -> dict:
+        """Plain-JSON form of the index, for from_snapshot() after a restart."""
+        return {
+            "generation": self.generation,
+            "complete": self.complete,
+            "builtAt": self.built_at,
+            "domains": [_public(r) for r in self._records],
+        }
+
+    @classmethod
+    def from_snapshot(cls, data: dict) -> "DomainIndex":
+        records = [DomainRecord(None, **item) for item in data.get("domains", [])]
+        return cls(records, generation=data["generation"], complete=data["complete"], built_at=data["builtAt"])
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the indexed domains, equal for two indexes with the same content."""
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for record in self._records:
+                digest.update(json.dumps(_public(record), sort_keys=True, default=str).encode())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def names(self) -> list[str]:
+        return [r.Name for r in self._records]
+
+    def get(self, name: str) -> Optional[DomainRecord]:
+        return self._by_name.get(name.lower())
+
+    def _prefix(self, prefix: str) -> list[DomainRecord]:
+        prefix = prefix.lower()
+        lo = bisect_left(self._names, prefix)
+        hi = bisect_left(self._names, prefix + "\uffff", lo)
+        return self._records[lo:hi]
+
+    def _expiring(self, after: Optional[str], before: Optional[str]) -> list[DomainRecord]:
+        lo = bisect_left(self._expiry_keys, after) if after else 0
+        hi = bisect_right(self._expiry_keys, before) if before else len(self._expiry_keys)
+        return self._by_expiry[lo:hi]
+
+    def query(
+        self,
+        name: Optional[str] = None,
+        prefix: Optional[str] = None,
+        user: Optional[str] = None,
+        expires_after: Optional[str] = None,
+        expires_before: Optional[str] = None,
+        expired: Optional[bool] = None,
+        auto_renew: Optional[bool] = None,
+        sort: str = "name",
+        offset: int = 0,
+        limit: int = 100,
+    ) -> tuple[int, list[dict]]:
+        """Returns (number of matches, one page of them as dicts).
+
+        The most selective indexed filter picks the candidates, the rest
+        are checked per record. sort is "name" or "expires".
+        """
+        by_expiry = expires_after is not None or expires_before is not None
+        if name is not None:
+            record = self.get(name)
+            candidates, source, ordered_by = [record] if record else [], "name", "name"
+        elif prefix:
+            candidates, source, ordered_by = self._prefix(prefix), "prefix", "name"
+        elif user is not None:
+            candidates, source, ordered_by = self._by_user.get(user, []), "user", "name"
+        elif by_expiry:
+            candidates, source, ordered_by = self._expiring(expires_after, expires_before), "expiry", "expires"
+        elif sort == "expires":
+            candidates, source, ordered_by = self._expiry_order, None, "expires"
+        else:
+            candidates, source, ordered_by = self._records, None, "name"
+
+        checks = []
+        if prefix and source != "prefix":
+            low = prefix.lower()
+            checks.append(lambda r: r.Name.lower().startswith(low))
+        if user is not None and source != "user":
+            checks.append(lambda r: r.User == user)
+        if by_expiry and source != "expiry":
+            checks.append(
+                lambda r: bool(r.Expires)
+                and (expires_after is None or r.Expires >= expires_after)
+                and (expires_before is None or r.Expires <= expires_before)
+            )
+        if expired is not None:
+            checks.append(lambda r: r.IsExpired == expired)
+        if auto_renew is not None:
+            checks.append(lambda r: r.AutoRenew == auto_renew)
+        if checks:
+            candidates = [r for r in candidates if all(check(r) for check in checks)]
+
+        if sort == "expires" and ordered_by != "expires":
+            candidates = sorted(candidates, key=lambda r: (r.Expires is None, r.Expires or ""))
+        elif sort == "name" and ordered_by != "name":
+            candidates = sorted(candidates, key=lambda r: r.Name.lower())
+
+        page = candidates[offset:offset + limit] if limit > 0 else []
+        return len(candidates), [_public(r) for r in page]
+
+
+if __name__ == "__main__":
+    import random
+
+    records = [
+        DomainRecord(
+            7, f"domain{i}.com", bool(i % 2), "2020-01-02",
+            f"20{random.randint(25, 35)}-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}" if i % 50 else None,
+            False, False, True, f"user{i % 300}",
+        )
+        for i in range(50000)
+    ]
+    t0 = time.perf_counter()
+    index = DomainIndex(records, generation=1)
+    print(f"build {len(index)} domains  {(time.perf_counter() - t0) * 1000:8.1f} ms")
+
+    queries = [
+        ("name", {"name": "domain4242.com"}),
+        ("prefix", {"prefix": "domain424"}),
+        ("user", {"user": "user42"}),
+        ("expiring", {"expires_after": "2026-01-01", "expires_before": "2026-01-31"}),
+        ("by expiry", {"sort": "expires", "offset": 1000}),
+        ("user+renew", {"user": "user42", "auto_renew": True, "sort": "expires"}),
+    ]
+    for label, params in queries:
+        total, page = index.query(**params)
+        rounds = 1000
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            index.query(**params)
+        print(f"{label:<12} {total:>6} matches  {(time.perf_counter() - t0) / rounds * 1e6:8.1f} us")
@@ -1,42 +1,121 @@
 import os
+import re
+import asyncio
 import httpx
 from datetime import datetime, timezone
+from service.bandwidth import compact_account
+from service.targets import Target
 
-HESTIA_API_KEY = os.getenv("HESTIA_API_KEY")
+_CONF_PAIR = re.compile(r"([A-Z0-9_]+)='([^']*)'")
 
 
-def _hestia_url():
-    return f"https://127.0.0.1:8083/api/"
+def _hestia_url(target: Target):
+    return f"{target.panel_url}/api/"
 
-async def _call(client: httpx.AsyncClient, cmd: str, *args) -> dict | list:
+async def _call(client: httpx.AsyncClient, target: Target, cmd: str, *args) -> dict | list:
+    """POST one Hestia API command; timeouts are those of the hestia client."""
     data = {
-        "hash": HESTIA_API_KEY,
+        "hash": target.api_key,
         "cmd": cmd,
     }
     for i, arg in enumerate(args, 1):
         data[f"arg{i}"] = arg
-    r = await client.post(_hestia_url(), data=data, timeout=30)
+    r = await client.post(_hestia_url(target), data=data)
     r.raise_for_status()
     return r.json()
 
 
-async def _fetch_users_with_domains(client: httpx.AsyncClient) -> dict:
-    users_data = await _call(client, "v-list-users", "json")
+async def _fetch_user_domains(
+    client: httpx.AsyncClient, target: Target, sem: asyncio.Semaphore, username: str, uinfo
+):
+    """Returns (username, info, domains, error) for one user, never raises.
+
+    The call is cut off after `target.hestia_user_timeout` seconds, on top
+    of the hestia client's own timeouts.
+    """
+    timeout = target.hestia_user_timeout
+    try:
+        async with sem:
+            d = await asyncio.wait_for(_call(client, target, "v-list-web-domains", username, "json"), timeout)
+        return username, uinfo, d if isinstance(d, dict) else {}, None
+    except asyncio.TimeoutError:
+        return username, uinfo, {}, f"timed out after {timeout:g}s"
+    except Exception as e:
+        return username, uinfo, {}, str(e) or type(e).__name__
+
+
+async def _iter_users_with_domains(client: httpx.AsyncClient, target: Target):
+    """Yields (username, info, domains, error) as each user's fetch completes.
+
+    Per-user calls run concurrently, at most `target.hestia_concurrency` at
+    a time. The admin user is skipped, its domains are never reported.
+    """
+    users_data = await _call(client, target, "v-list-users", "json")
     if not isinstance(users_data, dict):
-        return {}
-    result = {}
-    for username, uinfo in users_data.items():
-        domains = {}
+        return
+    sem = asyncio.Semaphore(max(1, target.hestia_concurrency))
+    tasks = [
+        asyncio.create_task(_fetch_user_domains(client, target, sem, username, uinfo))
+        for username, uinfo in users_data.items()
+        if username != "admin"
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _parse_conf_line(line: str) -> dict:
+    """Parse one Hestia conf line: KEY1='v1' KEY2='v2' ..."""
+    return dict(_CONF_PAIR.findall(line))
+
+
+def _read_user_dir(user_dir: str) -> tuple[dict, dict]:
+    """Returns (user.conf fields, {domain: web.conf fields}) for one user."""
+    uinfo = {}
+    try:
+        with open(os.path.join(user_dir, "user.conf"), encoding="utf-8") as f:
+            for line in f:
+                uinfo.update(_parse_conf_line(line))
+    except FileNotFoundError:
+        pass
+
+    domains = {}
+    try:
+        with open(os.path.join(user_dir, "web.conf"), encoding="utf-8") as f:
+            for line in f:
+                fields = _parse_conf_line(line)
+                name = fields.pop("DOMAIN", None)
+                if name:
+                    domains[name] = fields
+    except FileNotFoundError:
+        pass
+    return uinfo, domains
+
+
+def _scan_data_dir(data_dir: str) -> list[tuple]:
+    """Read every user's conf files, same tuples as _iter_users_with_domains."""
+    users_dir = os.path.join(data_dir, "users")
+    result = []
+    for username in sorted(os.listdir(users_dir)):
+        user_dir = os.path.join(users_dir, username)
+        if username == "admin" or not os.path.isdir(user_dir):
+            continue
         try:
-            d = await _call(client, "v-list-web-domains", username, "json")
-            if isinstance(d, dict):
-                domains = d
-        except Exception:
-            pass
-        result[username] = {"info": uinfo, "domains": domains}
+            uinfo, domains = _read_user_dir(user_dir)
+            result.append((username, uinfo, domains, None))
+        except Exception as e:
+            result.append((username, {}, {}, str(e) or type(e).__name__))
     return result
 
 
+async def _iter_users_from_files(data_dir: str):
+    for entry in await asyncio.to_thread(_scan_data_dir, data_dir):
+        yield entry
+
+
 def _main_domain(domains: list[str]) -> str:
     """Pick the most likely primary domain — fewest dots, then shortest."""
     if not domains:
@@ -44,62 +123,76 @@ def _main_domain(domains: list[str]) -> str:
     return min(domains, key=lambda d: (d.count("."), len(d)))
 
 
-async def fetch_all(client: httpx.AsyncClient) -> tuple[dict, list]:
-    """Returns (bandwidth_dict, domains_list) in one pass."""
-    try:
-        users = await _fetch_users_with_domains(client)
-    except Exception as e:
-        return {"error": str(e)}, []
+async def fetch_all(client: httpx.AsyncClient, target: Target) -> tuple[dict, list]:
+    """Returns (bandwidth_dict, domains_list) of `target` in one pass.
 
+    Users whose domains could not be listed are reported under
+    bandwidth["errors"] instead of failing the whole collection. With the
+    "files" collector (only on the Hestia host itself) the data directory
+    is read instead of the API. Accounts are trimmed with compact_account,
+    same as WHM's showbw.
+    """
     now = datetime.now(timezone.utc)
     acct = []
     total_bytes = 0
     all_domains = []
+    errors = []
 
-    for username, udata in users.items():
-        if username == "admin":
-            continue
-
-        domains = udata["domains"]
-        if not domains:
-            continue
-
-        bwusage = []
-        user_bytes = 0
-
-        for domain_name, dinfo in domains.items():
-            bw_mb = float(dinfo.get("U_BANDWIDTH", 0) or 0)
-            bw_bytes = int(bw_mb * 1024 * 1024)
-            user_bytes += bw_bytes
-            bwusage.append({
-                "domain": domain_name,
-                "usage": str(bw_bytes) if bw_bytes else 0,
+    try:
+        if target.hestia_collector == "files":
+            users = _iter_users_from_files(target.hestia_data_dir)
+        else:
+            users = _iter_users_with_domains(client, target)
+        async for username, uinfo, domains, error in users:
+            if error:
+                print(f"Hestia: failed to list domains for {username}: {error}")
+                errors.append({"user": username, "error": error})
+                continue
+            if not domains:
+                continue
+
+            bwusage = []
+            user_bytes = 0
+
+            for domain_name, dinfo in domains.items():
+                bw_mb = float(dinfo.get("U_BANDWIDTH", 0) or 0)
+                bw_bytes = int(bw_mb * 1024 * 1024)
+                user_bytes += bw_bytes
+                bwusage.append({
+                    "domain": domain_name,
+                    "usage": str(bw_bytes) if bw_bytes else 0,
+                    "deleted": 0,
+                })
+                suspended = str(dinfo.get("SUSPENDED", "no")).lower() == "yes"
+                all_domains.append({
+                    "Name": domain_name,
+                    "AutoRenew": "false",
+                    "Created": dinfo.get("DATE"),
+                    "Expires": None,
+                    "IsExpired": str(suspended).lower(),
+                    "IsLocked": "false",
+                    "IsOurDNS": "true",
+                    "User": username,
+                })
+
+            total_bytes += user_bytes
+            acct.append(compact_account({
+                "limit": 0,
+                "maindomain": _main_domain(list(domains.keys())),
+                "user": username,
+                "reseller": 0,
                 "deleted": 0,
-            })
-            suspended = str(dinfo.get("SUSPENDED", "no")).lower() == "yes"
-            all_domains.append({
-                "Name": domain_name,
-                "AutoRenew": "false",
-                "Created": dinfo.get("DATE"),
-                "Expires": None,
-                "IsExpired": str(suspended).lower(),
-                "IsLocked": "false",
-                "IsOurDNS": "true",
-                "User": username,
-            })
-
-        total_bytes += user_bytes
-        acct.append({
-            "limit": 0,
-            "maindomain": _main_domain(list(domains.keys())),
-            "user": username,
-            "reseller": 0,
-            "deleted": 0,
-            "bwusage": bwusage,
-            "bwlimited": 0,
-            "owner": "root",
-            "totalbytes": user_bytes,
-        })
+                "bwusage": bwusage,
+                "bwlimited": 0,
+                "owner": "root",
+                "totalbytes": user_bytes,
+            }))
+    except Exception as e:
+        return {"error": str(e)}, []
+
+    # users arrive in completion order; keep the output stable between runs
+    acct.sort(key=lambda a: a["user"])
+    all_domains.sort(key=lambda d: d["User"])
 
     bandwidth = {
         "metadata": {"result": 1, "version": 1, "command": "showbw", "reason": "OK"},
@@ -111,6 +204,8 @@ async def fetch_all(client: httpx.AsyncClient) -> tuple[dict, list]:
             "year": now.year,
         },
     }
+    if errors:
+        bandwidth["errors"] = errors
     return bandwidth, all_domains
 
 
@@ -119,7 +214,7 @@ if __name__ == "__main__":
 
     async def _test():
         async with httpx.AsyncClient(verify=False, timeout=30) as client:
-            bw, domains = await fetch_all(client)
+            bw, domains = await fetch_all(client, Target.from_env())
             print("\n=== bandwidth ===")
             print(json.dumps(bw, indent=2))
             print(f"\n=== domains ({len(domains)}) ===")
@@ -0,0 +1,291 @@
+import copy
+import time
+import uuid
+import asyncio
+import contextvars
+from collections import OrderedDict
+
+# held by whichever worker process is running a sync
+_RUN_LEASE = "sync-run"
+
+# what a job syncs: "full" is everything, "inventory" only the domain list
+FULL = "full"
+
+
+def _covers(running_kind: str, kind: str) -> bool:
+    """Whether a job of `running_kind` does what a `kind` trigger asks for."""
+    return running_kind == FULL or running_kind == kind
+
+# progress counters of the sync job the current task belongs to (tasks
+# started from the job inherit it), None outside of a job
+_progress = contextvars.ContextVar("sync_progress", default=None)
+
+
+def report_progress(key: str, n: int = 1):
+    """Add `n` to a progress counter of the running sync job, if any."""
+    progress = _progress.get()
+    if progress is not None:
+        progress[key] = progress.get(key, 0) + n
+
+
+def set_progress(key: str, value):
+    progress = _progress.get()
+    if progress is not None:
+        progress[key] = value
+
+
+class SyncJob:
+    def __init__(self, trigger: str, kind: str = FULL):
+        self.id = uuid.uuid4().hex
+        self.trigger = trigger
+        self.kind = kind
+        self.status = "running"
+        self.started_at = time.time()
+        self.finished_at = None
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self._task = None
+
+    async def wait(self) -> "SyncJob":
+        """Wait for the job to finish; cancelling the waiter leaves the job running."""
+        await asyncio.shield(self._task)
+        return self
+
+    def to_dict(self) -> dict:
+        return {
+            "jobId": self.id,
+            "trigger": self.trigger,
+            "kind": self.kind,
+            "status": self.status,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class RemoteSyncJob:
+    """A sync job of another worker process, as last published to the store."""
+
+    def __init__(self, store, data: dict):
+        self._store = store
+        self._data = data
+        self.id = data["jobId"]
+
+    @property
+    def status(self) -> str:
+        return self._data.get("status")
+
+    @property
+    def kind(self) -> str:
+        return self._data.get("kind", FULL)
+
+    @property
+    def result(self):
+        return self._data.get("result")
+
+    @property
+    def error(self):
+        return self._data.get("error")
+
+    async def wait(self, poll: float = 1.0) -> "RemoteSyncJob":
+        while self.status == "running":
+            await asyncio.sleep(poll)
+            # lease first: a job publishes its final state before letting go of it
+            holder = await asyncio.to_thread(self._store.lease_holder, _RUN_LEASE)
+            data = await asyncio.to_thread(self._store.get, f"sync_job:{self.id}")
+            if data:
+                self._data = data
+            if self.status == "running" and not (holder or "").endswith(f"/{self.id}"):
+                self._data = {**self._data, "status": "lost", "error": "The worker running this job went away"}
+        return self
+
+    def to_dict(self) -> dict:
+        return self._data
+
+
+class SyncRunner:
+    """Runs `run()` single-flight: triggering while a job is running
+    attaches to that job instead of starting another one.
+
+    A trigger may bring its own `run` and `kind` (e.g. a scheduled source
+    that covers only the domain inventory); it is single-flight with every
+    other job all the same. A trigger only attaches to a job that does at
+    least what it asks for: a full sync triggered during an inventory job
+    is queued and runs once that job is done, and further full triggers
+    attach to the queued one.
+
+    With a `store` (StateStore) this holds across worker processes: the
+    running job holds a lease, and jobs are published to the store so any
+    worker can attach to them or report on them. The last `history` jobs
+    stay available by id.
+    """
+
+    def __init__(self, run, history: int = 20, store=None, holder: str = None, lease_ttl: float = 30):
+        self._run = run
+        self._history = history
+        self._store = store
+        self._holder = holder or uuid.uuid4().hex
+        self._lease_ttl = lease_ttl
+        self._jobs = OrderedDict()
+        # store calls block, so they run in threads; this keeps two
+        # triggers of this process from both starting a job meanwhile
+        self._starting = asyncio.Lock()
+        self.current = None
+        # a full job waiting for a partial one to finish
+        self.queued = None
+        self.last = None
+
+    async def trigger(self, trigger: str = "api", run=None, kind: str = FULL) -> tuple:
+        """Returns (job, whether it attached to one already running or queued).
+
+        `run` replaces the runner's own `run()` for this job only, and
+        `kind` says what it syncs.
+        """
+        async with self._starting:
+            for existing in (self.current, self.queued):
+                if existing is not None and _covers(existing.kind, kind):
+                    return existing, True
+            job = SyncJob(trigger, kind)
+            blocker = self.current
+            if blocker is None and self._store is not None:
+                blocker = await asyncio.to_thread(self._claim, job)
+                if blocker is not None and _covers(blocker.kind, kind):
+                    return blocker, True
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._history:
+                self._jobs.popitem(last=False)
+            if blocker is None:
+                self.current = job
+                await self._publish(job)
+                job._task = asyncio.create_task(self._execute(job, run or self._run))
+            else:
+                job.status = "queued"
+                self.queued = job
+                await self._publish(job)
+                job._task = asyncio.create_task(self._run_after(job, blocker, run or self._run))
+            return job, False
+
+    async def _run_after(self, job: SyncJob, blocker, run):
+        """Run `job` once `blocker` (local or remote) is done."""
+        try:
+            while blocker is not None:
+                await blocker.wait()
+                async with self._starting:
+                    blocker = await asyncio.to_thread(self._claim, job) if self._store is not None else None
+                    if blocker is None:
+                        self.queued = None
+                        self.current = job
+                        job.status = "running"
+                        job.started_at = time.time()
+                        await self._publish(job)
+        except BaseException:
+            if job.status == "queued":
+                self.queued = None
+                job.status = "failed"
+                job.error = "Interrupted: the worker shut down"
+                job.finished_at = time.time()
+                await self._publish(job, finished=True)
+            raise
+        await self._execute(job, run)
+
+    async def shutdown(self):
+        """Stop the running and the queued job, if any. They are recorded
+        as failed and the run lease released before this returns."""
+        tasks = [job._task for job in (self.queued, self.current) if job is not None and job._task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _claim(self, job: SyncJob):
+        """Take the run lease for `job`, or return the job of the worker
+        holding it. Runs in a worker thread."""
+        for _ in range(2):
+            if self._store.acquire_lease(_RUN_LEASE, f"{self._holder}/{job.id}", self._lease_ttl):
+                return None
+            holder = self._store.lease_holder(_RUN_LEASE)
+            if holder is not None:
+                job_id = holder.rsplit("/", 1)[-1]
+                data = self._store.get(f"sync_job:{job_id}") or {"jobId": job_id, "status": "running"}
+                return RemoteSyncJob(self._store, data)
+        raise RuntimeError("Could not take the sync lease")
+
+    async def get(self, job_id: str):
+        job = self._jobs.get(job_id)
+        if job is None and self._store is not None:
+            data = await asyncio.to_thread(self._store.get, f"sync_job:{job_id}")
+            job = RemoteSyncJob(self._store, data) if data else None
+        return job
+
+    async def running(self):
+        """The job running in any worker, or None."""
+        if self.current is not None or self._store is None:
+            return self.current
+        holder = await asyncio.to_thread(self._store.lease_holder, _RUN_LEASE)
+        return await self.get(holder.rsplit("/", 1)[-1]) if holder else None
+
+    async def latest(self):
+        """The last finished job of any worker, or None."""
+        if self._store is None:
+            return self.last
+        job_id = await asyncio.to_thread(self._store.get, "sync_job_last")
+        return await self.get(job_id) if job_id else self.last
+
+    async def _publish(self, job: SyncJob, finished: bool = False):
+        if self._store is None:
+            return
+        try:
+            # the job keeps changing on the loop while the thread writes
+            await asyncio.to_thread(self._write_job, copy.deepcopy(job.to_dict()), finished)
+        except Exception as e:
+            print(f"Failed to publish sync job {job.id}: {e}")
+
+    def _write_job(self, data: dict, finished: bool):
+        job_id = data["jobId"]
+        self._store.set(f"sync_job:{job_id}", data)
+        if finished:
+            self._store.set("sync_job_last", job_id)
+            ids = [i for i in self._store.get("sync_jobs", []) if i != job_id] + [job_id]
+            for old in ids[:-self._history]:
+                self._store.delete(f"sync_job:{old}")
+            self._store.set("sync_jobs", ids[-self._history:])
+
+    async def _heartbeat(self, job: SyncJob):
+        """Keep the run lease and the published progress fresh."""
+        while True:
+            await asyncio.sleep(self._lease_ttl / 3)
+            try:
+                await asyncio.to_thread(
+                    self._store.acquire_lease, _RUN_LEASE, f"{self._holder}/{job.id}", self._lease_ttl
+                )
+            except Exception as e:
+                print(f"Failed to renew the sync lease: {e}")
+            await self._publish(job)
+
+    async def _execute(self, job: SyncJob, run):
+        _progress.set(job.progress)
+        heartbeat = asyncio.create_task(self._heartbeat(job)) if self._store is not None else None
+        try:
+            job.result = await run()
+            job.status = "succeeded"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            if job.status == "running":
+                job.status = "failed"
+                job.error = "Interrupted: the worker shut down"
+            try:
+                if heartbeat is not None:
+                    heartbeat.cancel()
+                    await self._publish(job, finished=True)
+                    try:
+                        await asyncio.to_thread(self._store.release_lease, _RUN_LEASE, f"{self._holder}/{job.id}")
+                    except Exception as e:
+                        print(f"Failed to release the sync lease: {e}")
+            finally:
+                self.current = None
+                self.last = job
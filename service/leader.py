@@ -0,0 +1,50 @@
+import os
+import uuid
+import socket
+import asyncio
+
+
+def process_id() -> str:
+    """Identifies this worker process in leases: host:pid:random."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaderElector:
+    """Keeps one worker process of a deployment the leader.
+
+    The leader holds the lease `name` in the shared StateStore and renews
+    it every ttl/3 seconds; if it dies the lease runs out and another
+    worker takes over within `ttl`. Without a store there is nothing to
+    coordinate with and this process is always the leader.
+    """
+
+    def __init__(self, store, name: str = "leader", ttl: float = 30, holder: str = None):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or process_id()
+        self.is_leader = store is None
+        # set once the first election round is over
+        self.decided = asyncio.Event()
+        if store is None:
+            self.decided.set()
+
+    async def run(self):
+        if self.store is None:
+            return
+        while True:
+            try:
+                leader = await asyncio.to_thread(self.store.acquire_lease, self.name, self.holder, self.ttl)
+            except Exception as e:
+                print(f"Leader lease check failed: {e}")
+                leader = False
+            if leader != self.is_leader:
+                print(f"Worker {self.holder} {'is now' if leader else 'is no longer'} the leader")
+            self.is_leader = leader
+            self.decided.set()
+            await asyncio.sleep(self.ttl / 3)
+
+    async def release(self):
+        if self.store is not None and self.is_leader:
+            self.is_leader = False
+            await asyncio.to_thread(self.store.release_lease, self.name, self.holder)
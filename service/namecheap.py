@@ -1,60 +1,88 @@
-import os
+import asyncio
 import httpx
-import xmltodict
 from urllib.parse import quote
-
-API_USER = os.getenv("API_USER")
-API_KEY = os.getenv("API_KEY")
-CLIENT_IP = os.getenv("CLIENT_IP")
-
-def _extract_namecheap_error(data: dict | None) -> str | None:
-    if not data:
-        return "Empty response from NameCheap"
-    api = data.get("ApiResponse") or {}
-    if str(api.get("@Status", "")).upper() != "ERROR":
-        return None
-    errors_container = api.get("Errors") or {}
-    errors = errors_container.get("Error")
-    if not errors:
-        return "NameCheap API error (no error details)"
-    if isinstance(errors, list):
-        msg = "; ".join([str(e.get("#text") if isinstance(e, dict) else e) for e in errors])
-        return msg or "NameCheap API error"
-    if isinstance(errors, dict):
-        return str(errors.get("#text") or "NameCheap API error")
-    return str(errors)
-
-
-async def fetch_balances(client: httpx.AsyncClient):
-    try:
-        api_url = (
-            f"https://api.namecheap.com/xml.response?"
-            f"ApiUser={quote(API_USER)}&ApiKey={quote(API_KEY)}"
-            f"&UserName={quote(API_USER)}&Command=namecheap.users.getBalances"
-            f"&ClientIp={quote(CLIENT_IP)}"
-        )
-
-        r = await client.get(api_url)
-
+from service.quota import INTERACTIVE, BULK
+from service.xmlstream import NamecheapResponseParser
+from service.jobs import report_progress, set_progress
+from service.targets import NamecheapAccount
+
+# what NameCheap applies when setHosts gets no TTL / MXPref
+DEFAULT_TTL = 1800
+DEFAULT_MX_PREF = 10
+
+# Every NameCheap API call goes through its account's QuotaScheduler, so
+# background syncs and operator requests share the account quota without
+# tripping it.
+
+def _api_url(account: NamecheapAccount, command: str) -> str:
+    return (
+        f"https://api.namecheap.com/xml.response?"
+        f"ApiUser={quote(account.api_user)}&ApiKey={quote(account.api_key)}"
+        f"&UserName={quote(account.api_user)}&Command={command}"
+        f"&ClientIp={quote(account.client_ip)}"
+    )
+
+
+def _require_credentials(account: NamecheapAccount):
+    if not (account and account.api_user and account.api_key and account.client_ip):
+        raise RuntimeError("NameCheap credentials missing: api_user/api_key/client_ip")
+
+
+async def _stream(
+    client: httpx.AsyncClient, account: NamecheapAccount, url: str, priority: int, parser: NamecheapResponseParser
+):
+    """GET url through the account's scheduler, yielding parsed items as the body streams in.
+
+    Raises the NameCheap error message once the body is complete.
+    """
+    await account.scheduler.acquire(priority)
+    async with client.stream("GET", url) as r:
         r.raise_for_status()
+        async for chunk in r.aiter_bytes():
+            for item in parser.feed(chunk):
+                yield item
+    for item in parser.close():
+        yield item
+    err = parser.error()
+    if err:
+        raise RuntimeError(err)
+
+
+async def _request(
+    client: httpx.AsyncClient, account: NamecheapAccount, url: str, priority: int, parser: NamecheapResponseParser
+):
+    """Like _stream, for calls whose answer is read from the parser's captures: nothing is kept."""
+    async for _ in _stream(client, account, url, priority, parser):
+        pass
+
+def normalize_domain(domain: str) -> str:
+    """Strip scheme, path and trailing dot: "https://Example.com/x" -> "example.com"."""
+    d = (domain or "").strip()
+    d = d.replace("https://", "").replace("http://", "")
+    d = d.split("/")[0].strip().rstrip(".").lower()
+    if d.count(".") < 1:
+        raise ValueError("Invalid domain. Expected format: example.com")
+    return d
+
+
+async def fetch_balances(client: httpx.AsyncClient, account: NamecheapAccount, priority: int = BULK):
+    try:
+        api_url = _api_url(account, "namecheap.users.getBalances")
 
-        data = xmltodict.parse(r.text)
-        err = _extract_namecheap_error(data)
-        if err:
-            raise RuntimeError(err)
+        parser = NamecheapResponseParser(capture=("UserGetBalancesResult",))
+        await _request(client, account, api_url, priority, parser)
 
-        command_response = (data.get("ApiResponse") or {}).get("CommandResponse") or {}
-        balance_result = command_response.get("UserGetBalancesResult")
+        balance_result = parser.results.get("UserGetBalancesResult")
         if not balance_result:
             return None
 
         return {
-            "currency": balance_result.get("@Currency"),
-            "availableBalance": float(balance_result.get("@AvailableBalance") or 0),
-            "accountBalance": float(balance_result.get("@AccountBalance") or 0),
-            "earnedAmount": float(balance_result.get("@EarnedAmount") or 0),
-            "withdrawableAmount": float(balance_result.get("@WithdrawableAmount") or 0),
-            "fundsRequiredForAutoRenew": float(balance_result.get("@FundsRequiredForAutoRenew") or 0),
+            "currency": balance_result.get("Currency"),
+            "availableBalance": float(balance_result.get("AvailableBalance") or 0),
+            "accountBalance": float(balance_result.get("AccountBalance") or 0),
+            "earnedAmount": float(balance_result.get("EarnedAmount") or 0),
+            "withdrawableAmount": float(balance_result.get("WithdrawableAmount") or 0),
+            "fundsRequiredForAutoRenew": float(balance_result.get("FundsRequiredForAutoRenew") or 0),
         }
 
     except Exception:
@@ -62,55 +90,95 @@ async def fetch_balances(client: httpx.AsyncClient):
 
 
 
-async def fetch_namecheap(client: httpx.AsyncClient):
-    try:
-        base_api_url = (
-            f"https://api.namecheap.com/xml.response?"
-            f"ApiUser={quote(API_USER)}&ApiKey={quote(API_KEY)}"
-            f"&UserName={quote(API_USER)}&Command=namecheap.domains.getList"
-            f"&ClientIp={quote(CLIENT_IP)}&Pagesize=100"
-        )
-
-        r = await client.get(f"{base_api_url}&Page=1")
-        r.raise_for_status()
+async def _with_retries(sem: asyncio.Semaphore, retries: int, fn, *args):
+    """Run fn under sem, retrying with exponential backoff.
 
-        data = xmltodict.parse(r.text)
-        err = _extract_namecheap_error(data)
-        if err:
-            raise RuntimeError(err)
+    The slot is released between attempts so a retrying call does not hold
+    up the others while it sleeps.
+    """
+    delay = 1
+    for attempt in range(1, max(1, retries) + 1):
+        try:
+            async with sem:
+                return await fn(*args)
+        except Exception:
+            if attempt >= retries:
+                raise
+        await asyncio.sleep(delay)
+        delay *= 2
 
-        command_response = (data.get("ApiResponse") or {}).get("CommandResponse") or {}
-        paging = command_response.get("Paging") or {}
-        total_items = int(paging.get("TotalItems", 0) or 0)
-        page_size = int(paging.get("PageSize", 100))
-        total_pages = (total_items + page_size - 1) // page_size
 
-        domains_result = command_response.get("DomainGetListResult") or {}
-        all_domains = domains_result.get("Domain") or []
-        if not isinstance(all_domains, list):
-            all_domains = [all_domains]
+async def _fetch_domain_page(
+    client: httpx.AsyncClient, account: NamecheapAccount, base_api_url: str, page: int
+) -> tuple[list, dict]:
+    """Fetch one page of namecheap.domains.getList, returns (domains, paging).
 
-        for page in range(2, total_pages + 1):
-            r = await client.get(f"{base_api_url}&Page={page}")
-            r.raise_for_status()
+    Domain rows keep the xmltodict-style "@"-prefixed attribute keys. The
+    rows end up in allDomains anyway, so a page is collected as it streams.
+    """
+    parser = NamecheapResponseParser(item_tag="Domain", prefix="@", capture_text=("TotalItems", "PageSize"))
+    domains = [d async for d in _stream(client, account, f"{base_api_url}&Page={page}", BULK, parser)]
+    return domains, {k: v for k, v in parser.texts.items() if v is not None}
 
-            page_data = xmltodict.parse(r.text)
-            paginated_command = (page_data.get("ApiResponse") or {}).get("CommandResponse") or {}
-            result = paginated_command.get("DomainGetListResult") or {}
-            domains_on_page = result.get("Domain") or []
 
-            if isinstance(domains_on_page, list):
-                all_domains.extend(domains_on_page)
-            else:
-                all_domains.append(domains_on_page)
+async def fetch_namecheap(client: httpx.AsyncClient, account: NamecheapAccount, include_balances: bool = True):
+    try:
+        base_api_url = f"{_api_url(account, 'namecheap.domains.getList')}&Pagesize=100"
+        sem = asyncio.Semaphore(max(1, account.concurrency))
+        retries = account.retries
 
-        balances = await fetch_balances(client)
+        all_domains, paging = await _with_retries(sem, retries, _fetch_domain_page, client, account, base_api_url, 1)
+        total_items = int(paging.get("TotalItems", 0) or 0)
+        page_size = int(paging.get("PageSize", 100))
+        total_pages = (total_items + page_size - 1) // page_size
+        set_progress("pagesTotal", max(1, total_pages))
+        report_progress("pagesFetched")
+
+        async def fetch_page(page):
+            try:
+                result = await _with_retries(sem, retries, _fetch_domain_page, client, account, base_api_url, page)
+            except Exception:
+                report_progress("pagesFailed")
+                raise
+            report_progress("pagesFetched")
+            return result
+
+        pages = list(range(2, total_pages + 1))
+        coros = [fetch_page(page) for page in pages]
+        if include_balances:
+            coros.insert(0, _with_retries(sem, retries, fetch_balances, client, account))
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        if include_balances:
+            balances, *page_results = results
+        else:
+            balances, page_results = {}, results
+        balances_failed = isinstance(balances, Exception)
+        if balances_failed:
+            print(f"NameCheap balances failed: {balances}")
+            balances = {}
+        elif isinstance(balances, BaseException):
+            raise balances
+
+        failed_pages = []
+        for page, result in zip(pages, page_results):
+            if isinstance(result, Exception):
+                print(f"NameCheap page {page} failed: {result}")
+                failed_pages.append(page)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                all_domains.extend(result[0])
 
-        return {
+        info = {
             "allDomains": all_domains,
             "balances": balances,
-            "status": "success",
+            "status": "partial" if failed_pages or balances_failed else "success",
         }
+        if failed_pages:
+            info["failedPages"] = failed_pages
+        if balances_failed:
+            info["balancesFailed"] = True
+        return info
 
     except Exception as e:
         return {
@@ -120,85 +188,55 @@ async def fetch_namecheap(client: httpx.AsyncClient):
             "balances": {},
         }
 
-async def fetch_domain_dns_records(client: httpx.AsyncClient, domain: str):
+async def fetch_domain_dns_records(
+    client: httpx.AsyncClient, account: NamecheapAccount, domain: str, priority: int = INTERACTIVE
+):
     try:
-        if not (API_USER and API_KEY and CLIENT_IP):
-            raise RuntimeError("NameCheap env vars missing: API_USER/API_KEY/CLIENT_IP")
-
-        d = (domain or "").strip()
-        d = d.replace("https://", "").replace("http://", "")
-        d = d.split("/")[0].strip().rstrip(".")
-        if d.count(".") < 1:
-            raise ValueError("Invalid domain. Expected format: example.com")
-
-        sld, tld = d.split(".", 1)
-
-        api_url = (
-            f"https://api.namecheap.com/xml.response?"
-            f"ApiUser={quote(API_USER)}&ApiKey={quote(API_KEY)}"
-            f"&UserName={quote(API_USER)}"
-            f"&Command=namecheap.domains.dns.getHosts"
-            f"&SLD={quote(sld)}&TLD={quote(tld)}"
-            f"&ClientIp={quote(CLIENT_IP)}"
-        )
-
-        r = await client.get(api_url)
-        r.raise_for_status()
+        _require_credentials(account)
 
-        data = xmltodict.parse(r.text)
-        err = _extract_namecheap_error(data)
-        if err:
-            raise RuntimeError(err)
+        sld, tld = normalize_domain(domain).split(".", 1)
 
-        command_response = (data.get("ApiResponse") or {}).get("CommandResponse") or {}
-        result = command_response.get("DomainDNSGetHostsResult")
-        if not result:
-            return []
-
-        hosts = result.get("host", [])
-        if isinstance(hosts, dict):
-            hosts = [hosts]
+        api_url = f"{_api_url(account, 'namecheap.domains.dns.getHosts')}&SLD={quote(sld)}&TLD={quote(tld)}"
 
+        parser = NamecheapResponseParser(item_tag="host", capture=("DomainDNSGetHostsResult",))
         records = []
-        for h in hosts:
+        async for h in _stream(client, account, api_url, priority, parser):
             records.append({
-                "name": h.get("@Name"),
-                "type": h.get("@Type"),
-                "address": h.get("@Address"),
-                "mxPref": h.get("@MXPref"),
-                "ttl": h.get("@TTL"),
-                "isActive": str(h.get("@IsActive")).lower() == "true",
+                "name": h.get("Name"),
+                "type": h.get("Type"),
+                "address": h.get("Address"),
+                "mxPref": h.get("MXPref"),
+                "ttl": h.get("TTL"),
+                "isActive": str(h.get("IsActive")).lower() == "true",
             })
 
+        if "DomainDNSGetHostsResult" not in parser.results:
+            return []
+
         return records
 
     except Exception:
         raise
 
-async def set_domain_dns_records(client: httpx.AsyncClient, domain: str, records: list):
+async def set_domain_dns_records(
+    client: httpx.AsyncClient, account: NamecheapAccount, domain: str, records: list, priority: int = INTERACTIVE
+):
     try:
-        if not (API_USER and API_KEY and CLIENT_IP):
-            raise RuntimeError("NameCheap env vars missing: API_USER/API_KEY/CLIENT_IP")
-
-        d = (domain or "").strip()
-        d = d.replace("https://", "").replace("http://", "")
-        d = d.split("/")[0].strip().rstrip(".")
-        if d.count(".") < 1:
-            raise ValueError("Invalid domain. Expected format: example.com")
+        _require_credentials(account)
 
-        sld, tld = d.split(".", 1)
+        sld, tld = normalize_domain(domain).split(".", 1)
 
         if not isinstance(records, list):
             raise ValueError("Records must be a list")
 
         params = {
-            "ApiUser": quote(API_USER),
-            "ApiKey": quote(API_KEY),
-            "UserName": quote(API_USER),
+            "ApiUser": quote(account.api_user),
+            "ApiKey": quote(account.api_key),
+            "UserName": quote(account.api_user),
             "Command": "namecheap.domains.dns.setHosts",
             "SLD": quote(sld),
             "TLD": quote(tld),
-            "ClientIp": quote(CLIENT_IP),
+            "ClientIp": quote(account.client_ip),
         }
 
         for idx, record in enumerate(records, start=1):
@@ -228,30 +266,63 @@ async def set_domain_dns_records(client: httpx.AsyncClient, domain: str, records
         query_string = "&".join([f"{k}={v}" for k, v in params.items()])
         api_url = f"https://api.namecheap.com/xml.response?{query_string}"
 
-        r = await client.get(api_url)
-        r.raise_for_status()
-
-        data = xmltodict.parse(r.text)
-        err = _extract_namecheap_error(data)
-        if err:
-            raise RuntimeError(err)
+        parser = NamecheapResponseParser(capture=("CommandResponse", "DomainDNSSetHostsResult"))
+        await _request(client, account, api_url, priority, parser)
 
-        command_response = data.get("ApiResponse", {}).get("CommandResponse")
-        if not command_response:
+        if "CommandResponse" not in parser.results:
             raise RuntimeError("Invalid response structure: CommandResponse not found")
 
-        result = command_response.get("DomainDNSSetHostsResult")
-        if not result:
+        result = parser.results.get("DomainDNSSetHostsResult")
+        if result is None:
             raise RuntimeError("Invalid response structure: DomainDNSSetHostsResult not found")
 
-        is_success = str(result.get("@IsSuccess", "")).lower() == "true"
+        is_success = str(result.get("IsSuccess", "")).lower() == "true"
         if not is_success:
             raise RuntimeError(f"Failed to set DNS records for domain {domain}")
 
         return {
-            "domain": result.get("@Domain"),
+            "domain": result.get("Domain"),
             "success": is_success,
         }
 
     except Exception:
         raise
+
+
+def _normalize_record(record: dict) -> dict:
+    """Canonical form of a host record, for comparing submitted and live records."""
+    record_type = str(record.get("type") or "").strip().upper()
+    address = str(record.get("address") or "").strip()
+    if record_type in ("CNAME", "MX", "NS", "ALIAS"):
+        address = address.rstrip(".").lower()
+    mx_pref = record.get("mxPref")
+    ttl = record.get("ttl")
+    return {
+        "name": str(record.get("name") or "").strip().lower(),
+        "type": record_type,
+        "address": address,
+        "mxPref": (int(mx_pref) if mx_pref not in (None, "") else DEFAULT_MX_PREF) if record_type == "MX" else None,
+        "ttl": int(ttl) if ttl not in (None, "") else DEFAULT_TTL,
+    }
+
+
+def diff_dns_records(current: list, desired: list) -> dict:
+    """Diff live host records against a desired full set.
+
+    Records are matched on (name, type, address); a matched record whose
+    TTL or MX preference differs is reported under "change".
+    """
+    def index(records):
+        result = {}
+        for record in records:
+            n = _normalize_record(record)
+            result[(n["name"], n["type"], n["address"])] = n
+        return result
+
+    live = index(current)
+    wanted = index(desired)
+    return {
+        "add": [r for k, r in wanted.items() if k not in live],
+        "remove": [r for k, r in live.items() if k not in wanted],
+        "change": [{"from": live[k], "to": r} for k, r in wanted.items() if k in live and live[k] != r],
+    }
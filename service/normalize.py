@@ -0,0 +1,228 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+# (output field, accepted source keys in order of preference, default)
+_FIELDS = (
+    ("Name", ("Name", "name"), None),
+    ("AutoRenew", ("AutoRenew", "autoRenew", "auto_renew"), "false"),
+    ("Created", ("Created", "created"), None),
+    ("Expires", ("Expires", "expires"), None),
+    ("IsExpired", ("IsExpired", "isExpired", "is_expired"), "false"),
+    ("IsLocked", ("IsLocked", "isLocked", "is_locked"), "false"),
+    ("IsOurDNS", ("IsOurDNS", "isOurDNS", "is_our_dns"), "false"),
+    ("User", ("User", "user"), None),
+)
+
+_BOOLS = {"true": True, "false": False, "True": True, "False": False, True: True, False: False}
+
+
+@dataclass(slots=True)
+class DomainRecord:
+    AccountId: object
+    Name: str
+    AutoRenew: bool
+    Created: Optional[str]
+    Expires: Optional[str]
+    IsExpired: bool
+    IsLocked: bool
+    IsOurDNS: bool
+    User: Optional[str]
+
+    def to_dict(self) -> dict:
+        return {
+            "AccountId": self.AccountId,
+            "Name": self.Name,
+            "AutoRenew": self.AutoRenew,
+            "Created": self.Created,
+            "Expires": self.Expires,
+            "IsExpired": self.IsExpired,
+            "IsLocked": self.IsLocked,
+            "IsOurDNS": self.IsOurDNS,
+            "User": self.User,
+        }
+
+
+@lru_cache(maxsize=16384)
+def format_date(date_str: Optional[str]):
+    """"MM/DD/YYYY" -> "YYYY-MM-DD"; anything else is returned unchanged."""
+    if not date_str:
+        return None
+    try:
+        month, day, year = date_str.split('/')
+        return f"{year}-{int(month):02d}-{int(day):02d}"
+    except Exception:
+        return date_str
+
+
+def _as_bool(value) -> bool:
+    try:
+        result = _BOOLS.get(value)
+    except TypeError:
+        result = None
+    return result if result is not None else str(value).lower() == "true"
+
+
+def _attrs(domain: dict) -> dict:
+    """Flatten one row of any supported shape into plain attribute keys."""
+    if "$" in domain and isinstance(domain["$"], dict):
+        return domain["$"]
+    if "@" in domain and isinstance(domain["@"], dict):
+        return domain["@"]
+    if any(isinstance(k, str) and k.startswith("@") for k in domain):
+        return {k[1:] if isinstance(k, str) and k.startswith("@") else k: v for k, v in domain.items()}
+    return domain
+
+
+def _normalize_row(domain: dict, account_id, default_user) -> Optional[DomainRecord]:
+    """Per-row path for rows that don't match the batch's schema."""
+    attrs = _attrs(domain)
+    values = []
+    for _, aliases, default in _FIELDS:
+        value = default
+        for alias in aliases:
+            v = attrs.get(alias)
+            if v is not None:
+                value = v
+                break
+        values.append(value)
+    name, auto_renew, created, expires, is_expired, is_locked, is_our_dns, user = values
+    if not name:
+        return None
+    return DomainRecord(
+        account_id, name, _as_bool(auto_renew), format_date(created), format_date(expires),
+        _as_bool(is_expired), _as_bool(is_locked), _as_bool(is_our_dns), user or default_user,
+    )
+
+
+def _detect_schema(sample: dict) -> tuple[Optional[str], str, dict]:
+    """Returns (wrapper key, key prefix, attributes of the sample row)."""
+    for wrapper in ("$", "@"):
+        if isinstance(sample.get(wrapper), dict):
+            return wrapper, "", sample[wrapper]
+    if any(isinstance(k, str) and k.startswith("@") for k in sample):
+        return None, "@", sample
+    return None, "", sample
+
+
+def normalize_domains(domains: list, account_id, default_user=None) -> list[DomainRecord]:
+    """Normalize registrar / panel domain rows into DomainRecords.
+
+    The schema (xmltodict "@" attributes, "$"/"@" wrappers, or plain keys as
+    produced by the Hestia collector) is detected once from the first row
+    and every field is read with a single key lookup. Rows that don't carry
+    the detected name key fall back to per-row detection. Rows without a
+    name are dropped.
+    """
+    sample = next((d for d in domains if isinstance(d, dict)), None)
+    if sample is None:
+        return []
+
+    wrapper, prefix, sample_attrs = _detect_schema(sample)
+    keys = []
+    for _, aliases, _ in _FIELDS:
+        candidates = [prefix + a for a in aliases]
+        keys.append(next((k for k in candidates if k in sample_attrs), candidates[0]))
+    k_name, k_auto, k_created, k_expires, k_expired, k_locked, k_dns, k_user = keys
+
+    records = []
+    append = records.append
+    for domain in domains:
+        if not isinstance(domain, dict):
+            continue
+        attrs = domain.get(wrapper) if wrapper else domain
+        if not isinstance(attrs, dict) or k_name not in attrs:
+            record = _normalize_row(domain, account_id, default_user)
+            if record is not None:
+                append(record)
+            continue
+        name = attrs[k_name]
+        if not name:
+            continue
+        get = attrs.get
+        append(DomainRecord(
+            account_id,
+            name,
+            _as_bool(get(k_auto, "false")),
+            format_date(get(k_created)),
+            format_date(get(k_expires)),
+            _as_bool(get(k_expired, "false")),
+            _as_bool(get(k_locked, "false")),
+            _as_bool(get(k_dns, "false")),
+            get(k_user) or default_user,
+        ))
+    return records
+
+
+if __name__ == "__main__":
+    import time
+    import random
+
+    def _legacy(domains, account_id, default_user):
+        # the per-row loop send_domains_to_server used before
+        out = []
+        for domain in domains:
+            attrs = {}
+            if isinstance(domain, dict):
+                if "$" in domain and isinstance(domain["$"], dict):
+                    attrs = domain["$"]
+                elif "@" in domain and isinstance(domain["@"], dict):
+                    attrs = domain["@"]
+                else:
+                    has_at_keys = any(k.startswith("@") for k in domain.keys())
+                    if has_at_keys:
+                        for k, v in domain.items():
+                            attrs[k[1:] if isinstance(k, str) and k.startswith("@") else k] = v
+                    else:
+                        attrs = domain.copy()
+            def get_attr(*names, default=None):
+                for n in names:
+                    if n is None:
+                        continue
+                    v = attrs.get(n)
+                    if v is not None:
+                        return v
+                return default
+            name = get_attr("Name", "name")
+            if not name:
+                continue
+            out.append({
+                "AccountId": account_id,
+                "Name": name,
+                "AutoRenew": str(get_attr("AutoRenew", "autoRenew", "auto_renew", default="false")).lower() == "true",
+                "Created": format_date.__wrapped__(get_attr("Created", "created")),
+                "Expires": format_date.__wrapped__(get_attr("Expires", "expires")),
+                "IsExpired": str(get_attr("IsExpired", "isExpired", "is_expired", default="false")).lower() == "true",
+                "IsLocked": str(get_attr("IsLocked", "isLocked", "is_locked", default="false")).lower() == "true",
+                "IsOurDNS": str(get_attr("IsOurDNS", "isOurDNS", "is_our_dns", default="false")).lower() == "true",
+                "User": get_attr("User", "user") or default_user,
+            })
+        return out
+
+    def _date():
+        return f"{random.randint(1, 12):02d}/{random.randint(1, 28):02d}/{random.randint(2015, 2035)}"
+
+    namecheap_rows = [
+        {
+            "@ID": str(i), "@Name": f"domain{i}.com", "@User": "reseller", "@Created": _date(),
+            "@Expires": _date(), "@IsExpired": "false", "@IsLocked": "false", "@AutoRenew": "true",
+            "@WhoisGuard": "ENABLED", "@IsPremium": "false", "@IsOurDNS": "true",
+        }
+        for i in range(50000)
+    ]
+    hestia_rows = [
+        {
+            "Name": f"site{i}.example", "AutoRenew": "false", "Created": "2024-01-02", "Expires": None,
+            "IsExpired": "false", "IsLocked": "false", "IsOurDNS": "true", "User": f"user{i % 300}",
+        }
+        for i in range(50000)
+    ]
+
+    for label, rows in (("namecheap", namecheap_rows), ("hestia", hestia_rows)):
+        assert [r.to_dict() for r in normalize_domains(rows, 7, "api")] == _legacy(rows, 7, "api")
+        for impl, fn in (("legacy loop", _legacy), ("compiled", normalize_domains)):
+            format_date.cache_clear()
+            t0 = time.perf_counter()
+            for _ in range(5):
+                fn(rows, 7, "api")
+            print(f"{label:<10} {len(rows)} rows  {impl:<12} {(time.perf_counter() - t0) / 5 * 1000:8.1f} ms")
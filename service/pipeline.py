@@ -0,0 +1,49 @@
+import time
+import asyncio
+
+
+class Pipeline:
+    """Runs named async stages as soon as the stages they depend on finish.
+
+    Each stage is `fn(results)` where `results` maps finished stage names to
+    their return values. Stages must be added after their dependencies.
+    Timings (offset from the pipeline start and duration, in seconds) are
+    kept in `timings`, also for stages that failed.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self.timings = {}
+
+    def add(self, name: str, fn, *deps: str):
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+        self._stages[name] = (fn, deps)
+
+    async def run(self) -> dict:
+        results = {}
+        tasks = {}
+        t0 = time.monotonic()
+
+        async def run_stage(name, fn, deps):
+            for dep in deps:
+                await tasks[dep]
+            started = time.monotonic()
+            try:
+                results[name] = await fn(results)
+            finally:
+                self.timings[name] = {
+                    "start": round(started - t0, 3),
+                    "seconds": round(time.monotonic() - started, 3),
+                }
+
+        for name, (fn, deps) in self._stages.items():
+            tasks[name] = asyncio.create_task(run_stage(name, fn, deps))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        return results
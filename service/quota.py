@@ -0,0 +1,153 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+# Lower value is served first.
+INTERACTIVE = 0
+BULK = 1
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+
+class TokenBucket:
+    """Allows `rate` calls per `per` seconds, with bursts of up to `rate`."""
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.capacity = float(rate)
+        self.fill_rate = rate / per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.fill_rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class QuotaScheduler:
+    """Hands out API calls in priority order without exceeding any bucket.
+
+    `limits` is a list of (calls, seconds) pairs; a call is granted only when
+    every bucket has a token. Waiters of the same priority are served FIFO.
+
+    With a `store` (StateStore) set, the buckets live in its SQLite file
+    under `name`, so every worker process sharing it draws from the same
+    quota; priorities are still only ordered within each process. If the
+    store fails, this process falls back to its own buckets.
+    """
+
+    def __init__(self, limits: list[tuple[int, float]], store=None, name: str = "quota"):
+        self.limits = [(rate, per) for rate, per in limits if rate > 0]
+        self.buckets = [TokenBucket(rate, per) for rate, per in self.limits]
+        self.store = store
+        self.name = name
+        self._queue = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self._granted = {}
+        self._wait_total = {}
+        self._wait_max = {}
+
+    def _wait_time(self, now: float) -> float:
+        return max((b.wait_time(now) for b in self.buckets), default=0.0)
+
+    async def _take(self) -> float:
+        """Take a token from every bucket if each has one.
+
+        Returns 0 when it did, otherwise how long until it could.
+        """
+        if self.store is not None:
+            try:
+                wait, levels = await asyncio.to_thread(self.store.take_quota, self.name, self.limits)
+            except Exception as e:
+                print(f"Shared quota {self.name} unavailable, using this process's own buckets: {e}")
+            else:
+                # mirrored for stats() and as the starting point of a fallback
+                now = time.monotonic()
+                for b, tokens in zip(self.buckets, levels):
+                    b.tokens, b.updated = tokens, now
+                return wait
+        wait = self._wait_time(time.monotonic())
+        if wait == 0:
+            for b in self.buckets:
+                b.take()
+        return wait
+
+    def _grant(self, priority: int, waited: float):
+        self._granted[priority] = self._granted.get(priority, 0) + 1
+        self._wait_total[priority] = self._wait_total.get(priority, 0.0) + waited
+        self._wait_max[priority] = max(self._wait_max.get(priority, 0.0), waited)
+
+    async def acquire(self, priority: int = BULK):
+        now = time.monotonic()
+        if not self._queue and await self._take() == 0:
+            self._grant(priority, time.monotonic() - now)
+            return
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), now, fut))
+        if self._dispatcher is None or self._dispatcher.done() or self._dispatcher.get_loop() is not loop:
+            self._dispatcher = loop.create_task(self._dispatch())
+        await fut
+
+    async def _dispatch(self):
+        while self._queue:
+            priority, _, queued_at, fut = self._queue[0]
+            if fut.done():
+                # the caller was cancelled while queued
+                heapq.heappop(self._queue)
+                continue
+            wait = await self._take()
+            if wait > 0:
+                # re-check the head afterwards: something more urgent may have arrived
+                await asyncio.sleep(wait)
+                continue
+            # the token goes to whoever is most urgent now, which may have
+            # changed while it was being taken
+            while self._queue:
+                priority, _, queued_at, fut = heapq.heappop(self._queue)
+                if not fut.done():
+                    self._grant(priority, time.monotonic() - queued_at)
+                    fut.set_result(None)
+                    break
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        depth = {}
+        oldest = 0.0
+        for priority, _, queued_at, fut in self._queue:
+            if fut.done():
+                continue
+            name = PRIORITY_NAMES.get(priority, str(priority))
+            depth[name] = depth.get(name, 0) + 1
+            oldest = max(oldest, now - queued_at)
+
+        by_priority = {}
+        for priority, granted in self._granted.items():
+            by_priority[PRIORITY_NAMES.get(priority, str(priority))] = {
+                "granted": granted,
+                "avg_wait_seconds": round(self._wait_total[priority] / granted, 3),
+                "max_wait_seconds": round(self._wait_max[priority], 3),
+            }
+
+        self._wait_time(now)
+        return {
+            "shared": self.store is not None,
+            "queue_depth": sum(depth.values()),
+            "queue_depth_by_priority": depth,
+            "oldest_wait_seconds": round(oldest, 3),
+            "priorities": by_priority,
+            "buckets": [
+                {"rate": b.rate, "per_seconds": b.per, "available": round(b.tokens, 2)}
+                for b in self.buckets
+            ],
+        }
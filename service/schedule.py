@@ -0,0 +1,253 @@
+import time
+import random
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+
+class SourceSchedule:
+    """When one sync source should run next.
+
+    After a run that changed something the source comes back after
+    `interval`. Every run in a row without a change stretches that by
+    another `interval`, up to `max_factor` times it. After failures it is
+    retried sooner, starting at `retry_min` and doubling, but never later
+    than `interval`. Delays get +/- `jitter` (a fraction) so sources and
+    deployments don't line up.
+    """
+
+    def __init__(self, name: str, interval: float, max_factor: float = 4, jitter: float = 0.1, retry_min: float = 60):
+        self.name = name
+        self.interval = interval
+        self.max_factor = max(1, max_factor)
+        self.jitter = jitter
+        self.retry_min = retry_min
+        self.last_run = None
+        self.last_success = None
+        self.last_error = None
+        self.fingerprint = None
+        self.unchanged = 0
+        self.failures = 0
+        self.next_run = None
+
+    def record(self, ok: bool, fingerprint: str = None, error: str = None, now: float = None) -> float:
+        """Fold in the outcome of a run; returns the delay until the next one."""
+        now = now or time.time()
+        self.last_run = now
+        if ok:
+            self.last_success = now
+            self.last_error = None
+            self.failures = 0
+            if fingerprint is not None and fingerprint == self.fingerprint:
+                self.unchanged += 1
+            else:
+                self.unchanged = 0
+            self.fingerprint = fingerprint
+            delay = min(self.interval * (1 + self.unchanged), self.interval * self.max_factor)
+        else:
+            self.failures += 1
+            self.last_error = error
+            delay = min(self.interval, self.retry_min * 2 ** (self.failures - 1))
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        self.next_run = now + delay
+        return delay
+
+    def to_dict(self) -> dict:
+        return {
+            "interval": self.interval,
+            "lastRun": self.last_run,
+            "lastSuccess": self.last_success,
+            "lastError": self.last_error,
+            "fingerprint": self.fingerprint,
+            "unchangedRuns": self.unchanged,
+            "failures": self.failures,
+            "nextRun": self.next_run,
+        }
+
+    def load(self, data: dict):
+        self.last_run = data.get("lastRun")
+        self.last_success = data.get("lastSuccess")
+        self.last_error = data.get("lastError")
+        self.fingerprint = data.get("fingerprint")
+        self.unchanged = data.get("unchangedRuns", 0)
+        self.failures = data.get("failures", 0)
+        self.next_run = data.get("nextRun")
+
+
+class FairLimiter:
+    """Lets at most `limit` callers hold a slot at once.
+
+    Waiters queue per key (e.g. a target), and a freed slot goes to the
+    next key in turn rather than to the oldest waiter, so one key with many
+    queued calls can't hold back the others.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.active = 0
+        self._waiting = OrderedDict()
+
+    @asynccontextmanager
+    async def slot(self, key=None):
+        if self.active < self.limit and not self._waiting:
+            self.active += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiting.setdefault(key, deque()).append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    # the slot was handed over just before the cancellation
+                    self._release()
+                else:
+                    queue = self._waiting.get(key)
+                    if queue is not None and fut in queue:
+                        queue.remove(fut)
+                        if not queue:
+                            del self._waiting[key]
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        while self._waiting:
+            key, queue = next(iter(self._waiting.items()))
+            fut = queue.popleft()
+            if queue:
+                self._waiting.move_to_end(key)
+            else:
+                del self._waiting[key]
+            if not fut.done():
+                # the slot passes straight to the waiter, `active` stays the same
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": {str(key): len(queue) for key, queue in self._waiting.items()},
+        }
+
+
+class SourceScheduler:
+    """Runs each sync source on its own SourceSchedule through apscheduler.
+
+    A source is `fn()` returning a fingerprint of what it pushed (None if
+    it can't tell); raising counts as a failure. With a `leader`
+    (LeaderElector) only the leader runs sources and the others check
+    back every `idle_check` seconds. With a `store` the schedules are kept
+    in the state file, so a new leader continues where the old one was.
+    With a `limiter` (FairLimiter) each run takes a slot first, keyed on the
+    source's `group`, unless the source was added with `limit=False`
+    because it takes one itself.
+    """
+
+    def __init__(self, store=None, leader=None, idle_check: float = 10, limiter: FairLimiter = None):
+        self.store = store
+        self.leader = leader
+        self.idle_check = idle_check
+        self.limiter = limiter
+        self.sources = {}
+        self._scheduler = AsyncIOScheduler(timezone=timezone.utc)
+        # runs in progress, so shutdown() can stop them
+        self._running = set()
+
+    async def add(self, name: str, fn, schedule: SourceSchedule, run_now: bool = False, group=None, limit: bool = True):
+        self.sources[name] = (fn, schedule, group, limit)
+        await self._reload(schedule)
+        first = time.time() if run_now or schedule.next_run is None else schedule.next_run
+        self._arm(name, first, force=run_now)
+
+    def start(self):
+        self._scheduler.start()
+
+    async def shutdown(self):
+        """Stop scheduling and cancel the runs in progress."""
+        self._scheduler.shutdown(wait=False)
+        for task in self._running:
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    def _arm(self, name: str, at: float, force: bool = False):
+        self._scheduler.add_job(
+            self._run,
+            "date",
+            run_date=datetime.fromtimestamp(max(at, time.time()), timezone.utc),
+            args=[name, force],
+            id=name,
+            replace_existing=True,
+            misfire_grace_time=None,
+        )
+
+    async def _reload(self, schedule: SourceSchedule):
+        if self.store is not None:
+            saved = await asyncio.to_thread(self.store.get, f"schedule:{schedule.name}")
+            if saved:
+                schedule.load(saved)
+
+    async def _call(self, fn, group, limit: bool):
+        if self.limiter is None or not limit:
+            return await fn()
+        async with self.limiter.slot(group):
+            return await fn()
+
+    async def _run(self, name: str, force: bool = False):
+        task = asyncio.current_task()
+        self._running.add(task)
+        try:
+            await self._run_source(name, force)
+        finally:
+            self._running.discard(task)
+
+    async def _run_source(self, name: str, force: bool):
+        fn, schedule, group, limit = self.sources[name]
+        if self.leader is not None and not self.leader.is_leader:
+            self._arm(name, time.time() + self.idle_check)
+            return
+        # another leader may have run it since this worker last looked
+        await self._reload(schedule)
+        if not force and schedule.next_run and schedule.next_run > time.time() + 1:
+            self._arm(name, schedule.next_run)
+            return
+
+        try:
+            fingerprint = await self._call(fn, group, limit)
+            delay = schedule.record(True, fingerprint)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Scheduled {name} sync failed: {e}")
+            delay = schedule.record(False, error=str(e))
+        if self.store is not None:
+            try:
+                await asyncio.to_thread(self.store.set, f"schedule:{name}", schedule.to_dict())
+            except Exception as e:
+                print(f"Failed to save the {name} schedule: {e}")
+        self._arm(name, time.time() + delay)
+
+    async def stats(self, names=None) -> dict:
+        """Schedules of all sources (or of `names`), as last saved by
+        whichever worker ran them."""
+        result = {}
+        for name, (_, schedule, _, _) in self.sources.items():
+            if names is None or name in names:
+                await self._reload(schedule)
+                result[name] = schedule.to_dict()
+        return result
+
+
+if __name__ == "__main__":
+    schedule = SourceSchedule("inventory", 6 * 3600, jitter=0)
+    t = 0
+    for ok, fp in [(True, "a"), (True, "a"), (True, "a"), (True, "a"), (True, "a"), (True, "b"), (False, None), (False, None), (True, "b")]:
+        delay = schedule.record(ok, fp, error=None if ok else "boom", now=t + 1)
+        print(f"ok={ok!s:<5} fingerprint={fp!s:<4} next in {delay / 3600:5.2f} h")
+        t += delay
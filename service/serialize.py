@@ -0,0 +1,92 @@
+import os
+import json
+import dataclasses
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# "auto" uses orjson when it is installed, "stdlib" forces the json module
+JSON_ENCODER = os.getenv("JSON_ENCODER", "auto").lower()
+
+_use_orjson = orjson is not None and JSON_ENCODER != "stdlib"
+
+
+def _default(obj):
+    to_dict = getattr(obj, "to_dict", None)
+    if to_dict is not None:
+        return to_dict()
+    if dataclasses.is_dataclass(obj):
+        return dataclasses.asdict(obj)
+    return str(obj)
+
+
+def dumps(obj, sort_keys: bool = False) -> bytes:
+    """Serialize to compact UTF-8 JSON bytes.
+
+    Objects with a to_dict() (e.g. DomainRecord) are encoded through it;
+    anything else unknown becomes str().
+    """
+    if _use_orjson:
+        return _orjson_dumps(obj, sort_keys)
+    return _stdlib_dumps(obj, sort_keys)
+
+
+def _orjson_dumps(obj, sort_keys: bool = False) -> bytes:
+    # orjson's native path for slotted dataclasses is slower than to_dict()
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(obj, default=_default, option=option)
+
+
+def _stdlib_dumps(obj, sort_keys: bool = False) -> bytes:
+    return json.dumps(
+        obj, default=_default, sort_keys=sort_keys, separators=(",", ":"), ensure_ascii=False
+    ).encode()
+
+
+if __name__ == "__main__":
+    import time
+    import random
+    from service.normalize import DomainRecord
+
+    domains = [
+        DomainRecord(
+            7, f"domain{i}.com", bool(i % 2), "2020-01-02", f"20{random.randint(25, 35)}-0{random.randint(1, 9)}-15",
+            False, False, True, f"user{i % 300}",
+        )
+        for i in range(50000)
+    ]
+    bandwidth = {
+        "data": {
+            "acct": [
+                {
+                    "user": f"user{u}",
+                    "maindomain": f"site{u}.example",
+                    "totalbytes": random.randint(0, 10 ** 10),
+                    "bwusage": [{"domain": f"d{u}-{d}.example", "usage": str(random.randint(0, 10 ** 8)), "deleted": 0} for d in range(20)],
+                }
+                for u in range(300)
+            ],
+        },
+    }
+    payload = {"accountId": 7, "domains": domains, "bandwidth": bandwidth}
+
+    def _before(obj):
+        # what httpx's json= did: json.dumps to str, then encode
+        return json.dumps(obj, default=_default).encode()
+
+    encoders = [("json= (before)", _before), ("stdlib", _stdlib_dumps)]
+    if orjson is not None:
+        encoders.append(("orjson", _orjson_dumps))
+    else:
+        print("orjson is not installed, skipping it")
+
+    for label, fn in encoders:
+        fn(payload)
+        t0 = time.perf_counter()
+        for _ in range(5):
+            body = fn(payload)
+        print(f"50000 domains  {label:<15} {(time.perf_counter() - t0) / 5 * 1000:8.1f} ms  {len(body) / 1024:8.0f} KiB")
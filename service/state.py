@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS domains (
+    account_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (account_id, name)
+);
+CREATE TABLE IF NOT EXISTS bandwidth_samples (
+    ts REAL NOT NULL,
+    period TEXT NOT NULL,
+    user TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bandwidth_samples_series
+    ON bandwidth_samples (user, domain, ts);
+CREATE INDEX IF NOT EXISTS bandwidth_samples_ts ON bandwidth_samples (ts);
+CREATE TABLE IF NOT EXISTS bandwidth_totals (
+    period TEXT NOT NULL,
+    user TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    sent_bytes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, user, domain)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS quota_buckets (
+    name TEXT NOT NULL,
+    per REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (name, per)
+);
+CREATE TABLE IF NOT EXISTS dns_cache (
+    domain TEXT PRIMARY KEY,
+    records TEXT,
+    etag TEXT,
+    expires_at REAL NOT NULL DEFAULT 0,
+    invalidated_at REAL NOT NULL DEFAULT 0
+);
+"""
+
+
+class StateStore:
+    """Small SQLite store for connector state that should survive restarts.
+
+    Worker processes of one deployment open the same file, which is also
+    how they coordinate (leases) and share caches.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+
+    def domain_fingerprints(self, account_id) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, fingerprint FROM domains WHERE account_id = ?", (str(account_id),)
+            ).fetchall()
+        return dict(rows)
+
+    def update_domains(self, account_id, upserts: dict, removed: list):
+        """Record fingerprints for uploaded domains and forget removed ones."""
+        account_id = str(account_id)
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO domains (account_id, name, fingerprint) VALUES (?, ?, ?)",
+                [(account_id, name, fp) for name, fp in upserts.items()],
+            )
+            self._conn.executemany(
+                "DELETE FROM domains WHERE account_id = ? AND name = ?",
+                [(account_id, name) for name in removed],
+            )
+
+    def replace_domains(self, account_id, fingerprints: dict):
+        """Make `fingerprints` the complete known state for the account."""
+        account_id = str(account_id)
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM domains WHERE account_id = ?", (account_id,))
+            self._conn.executemany(
+                "INSERT INTO domains (account_id, name, fingerprint) VALUES (?, ?, ?)",
+                [(account_id, name, fp) for name, fp in fingerprints.items()],
+            )
+
+    def record_bandwidth(self, ts: float, period: str, totals: dict, keep_since: float = None):
+        """Store one month-to-date snapshot {(user, domain): bytes}.
+
+        A sample is appended only for series whose total changed, so the
+        history stays compact. domain "" is the account total. Samples older
+        than `keep_since` are dropped.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            known = dict(
+                ((user, domain), value)
+                for user, domain, value in self._conn.execute(
+                    "SELECT user, domain, bytes FROM bandwidth_totals WHERE period = ?", (period,)
+                )
+            )
+            changed = [(key, value) for key, value in totals.items() if known.get(key) != value]
+            self._conn.executemany(
+                "INSERT INTO bandwidth_samples (ts, period, user, domain, bytes) VALUES (?, ?, ?, ?, ?)",
+                [(ts, period, user, domain, value) for (user, domain), value in changed],
+            )
+            self._conn.executemany(
+                "INSERT INTO bandwidth_totals (period, user, domain, bytes, ts) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (period, user, domain) DO UPDATE SET bytes = excluded.bytes, ts = excluded.ts",
+                [(period, user, domain, value, ts) for (user, domain), value in changed],
+            )
+            if keep_since is not None:
+                self._conn.execute("DELETE FROM bandwidth_samples WHERE ts < ?", (keep_since,))
+                # totals of old months are only kept while they still have something unsent
+                self._conn.execute(
+                    "DELETE FROM bandwidth_totals WHERE ts < ? AND period != ? AND bytes = sent_bytes",
+                    (keep_since, period),
+                )
+
+    def unsent_bandwidth(self) -> list[tuple]:
+        """[(period, user, domain, bytes, sent_bytes), ...] for series not reported yet."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT period, user, domain, bytes, sent_bytes FROM bandwidth_totals "
+                "WHERE bytes != sent_bytes ORDER BY period, user, domain"
+            ).fetchall()
+
+    def mark_bandwidth_sent(self, rows: list[tuple]):
+        """Remember that the totals in `rows` (period, user, domain, bytes) reached the backend."""
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "UPDATE bandwidth_totals SET sent_bytes = ? WHERE period = ? AND user = ? AND domain = ?",
+                [(value, period, user, domain) for period, user, domain, value in rows],
+            )
+
+    def bandwidth_history(self, user=None, domain=None, since=None, until=None, limit: int = 1000) -> list[dict]:
+        """Samples, newest first, each with the delta to the previous sample of its series."""
+        where = []
+        params = []
+        for clause, value in (("user = ?", user), ("domain = ?", domain)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        outer = []
+        for clause, value in (("ts >= ?", since), ("ts <= ?", until)):
+            if value is not None:
+                outer.append(clause)
+                params.append(value)
+        params.append(limit)
+        query = (
+            "SELECT ts, period, user, domain, bytes, delta FROM ("
+            "SELECT ts, period, user, domain, bytes, "
+            "bytes - LAG(bytes, 1, 0) OVER (PARTITION BY period, user, domain ORDER BY ts) AS delta "
+            "FROM bandwidth_samples" + (" WHERE " + " AND ".join(where) if where else "") + ")"
+            + (" WHERE " + " AND ".join(outer) if outer else "")
+            + " ORDER BY ts DESC, user, domain LIMIT ?"
+        )
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            {"ts": ts, "period": period, "user": user, "domain": domain, "bytes": value, "delta": delta}
+            for ts, period, user, domain, value, delta in rows
+        ]
+
+    def bandwidth_periods(self) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT period FROM bandwidth_totals ORDER BY period DESC").fetchall()
+        return [row[0] for row in rows]
+
+    def top_bandwidth(self, period: str, n: int = 10, by: str = "account", user=None) -> list[dict]:
+        """The `n` biggest accounts (domain "") or domains of `period`."""
+        params = [period]
+        query = "SELECT user, domain, bytes, ts FROM bandwidth_totals WHERE period = ? AND domain "
+        query += "= ''" if by == "account" else "!= ''"
+        if user is not None:
+            query += " AND user = ?"
+            params.append(user)
+        query += " ORDER BY bytes DESC, user, domain LIMIT ?"
+        params.append(n)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        if by == "account":
+            return [{"user": u, "bytes": value, "updatedAt": ts} for u, _, value, ts in rows]
+        return [{"user": u, "domain": d, "bytes": value, "updatedAt": ts} for u, d, value, ts in rows]
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Take or renew the lease `name` for `ttl` seconds.
+
+        Fails while another holder has an unexpired lease.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute("SELECT holder, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if row and row[0] != holder and row[1] > now:
+                return False
+            self._conn.execute(
+                "INSERT OR REPLACE INTO leases (name, holder, expires_at) VALUES (?, ?, ?)",
+                (name, holder, now + ttl),
+            )
+            return True
+
+    def release_lease(self, name: str, holder: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    def lease_holder(self, name: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT holder FROM leases WHERE name = ? AND expires_at > ?", (name, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def take_quota(self, name: str, limits: list[tuple[int, float]]) -> tuple[float, list[float]]:
+        """Take one call from each (rate, per seconds) token bucket of `name`,
+        if every one of them has a token; shared by all processes using the file.
+
+        Returns (0, tokens left) when the call was granted, otherwise
+        (seconds until it would be, tokens available).
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            saved = {
+                per: (tokens, updated)
+                for per, tokens, updated in self._conn.execute(
+                    "SELECT per, tokens, updated FROM quota_buckets WHERE name = ?", (name,)
+                )
+            }
+            levels = []
+            wait = 0.0
+            for rate, per in limits:
+                tokens, updated = saved.get(float(per), (rate, now))
+                tokens = min(float(rate), tokens + max(0.0, now - updated) * rate / per)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) * per / rate)
+                levels.append(tokens)
+            if wait == 0:
+                levels = [tokens - 1 for tokens in levels]
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO quota_buckets (name, per, tokens, updated) VALUES (?, ?, ?, ?)",
+                [(name, float(per), tokens, now) for (_, per), tokens in zip(limits, levels)],
+            )
+            return wait, levels
+
+    def dns_cache_get(self, domain: str):
+        """(records, etag) if there is an unexpired entry for `domain`."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT records, etag FROM dns_cache WHERE domain = ? AND records IS NOT NULL AND expires_at > ?",
+                (domain, time.time()),
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def dns_cache_put(self, domain: str, records: list, etag: str, ttl: float, loaded_since: float, max_size: int):
+        """Store an entry unless `domain` was invalidated after `loaded_since`."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute(
+                "INSERT INTO dns_cache (domain, records, etag, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (domain) DO UPDATE SET records = excluded.records, etag = excluded.etag, "
+                "expires_at = excluded.expires_at WHERE dns_cache.invalidated_at <= ?",
+                (domain, json.dumps(records), etag, now + ttl, loaded_since),
+            )
+            # invalidation markers only matter while a load that raced them can still finish
+            self._conn.execute(
+                "DELETE FROM dns_cache WHERE expires_at <= ? AND invalidated_at < ?", (now, now - 300)
+            )
+            self._conn.execute(
+                "DELETE FROM dns_cache WHERE domain IN (SELECT domain FROM dns_cache "
+                "WHERE records IS NOT NULL ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (max_size,),
+            )
+
+    def dns_cache_invalidate(self, domain: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO dns_cache (domain, invalidated_at) VALUES (?, ?) "
+                "ON CONFLICT (domain) DO UPDATE SET records = NULL, etag = NULL, expires_at = 0, "
+                "invalidated_at = excluded.invalidated_at",
+                (domain, time.time()),
+            )
+
+    def dns_cache_count(self) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM dns_cache WHERE records IS NOT NULL AND expires_at > ?", (time.time(),)
+            ).fetchone()
+        return row[0]
@@ -0,0 +1,197 @@
+import os
+import re
+import json
+from dataclasses import dataclass, field, fields
+from typing import Optional
+from service.quota import QuotaScheduler
+from service.clients import UpstreamSettings
+
+_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+_VAR = re.compile(r"\$\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+@dataclass
+class NamecheapAccount:
+    """Credentials and limits of one NameCheap API account.
+
+    NameCheap counts its rate limits per account, so every call made with
+    an account goes through that account's own QuotaScheduler.
+    """
+
+    name: str
+    api_user: str
+    api_key: str
+    client_ip: str
+    concurrency: int = 4
+    retries: int = 3
+    rate_per_minute: int = 20
+    rate_per_hour: int = 700
+    rate_per_day: int = 8000
+    scheduler: QuotaScheduler = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.scheduler = QuotaScheduler([
+            (self.rate_per_minute, 60),
+            (self.rate_per_hour, 60 * 60),
+            (self.rate_per_day, 24 * 60 * 60),
+        ])
+
+    @classmethod
+    def from_env(cls, name: str = "default") -> "NamecheapAccount":
+        return cls(
+            name=name,
+            api_user=os.getenv("API_USER"),
+            api_key=os.getenv("API_KEY"),
+            client_ip=os.getenv("CLIENT_IP"),
+            concurrency=int(os.getenv("NAMECHEAP_CONCURRENCY", 4)),
+            retries=int(os.getenv("NAMECHEAP_RETRIES", 3)),
+            rate_per_minute=int(os.getenv("NAMECHEAP_RATE_PER_MINUTE", 20)),
+            rate_per_hour=int(os.getenv("NAMECHEAP_RATE_PER_HOUR", 700)),
+            rate_per_day=int(os.getenv("NAMECHEAP_RATE_PER_DAY", 8000)),
+        )
+
+
+@dataclass
+class Target:
+    """One WHM or Hestia server, synced to the backend as one account,
+    with the NameCheap account (if any) whose domains and balances go
+    with it.
+
+    `host` is the server address reported to the backend; the panel API is
+    reached at `panel_url`, which defaults to WHM on that host or the
+    local Hestia API.
+    """
+
+    name: str
+    panel: str = "whm"
+    host: Optional[str] = None
+    panel_url: Optional[str] = None
+    api_key: Optional[str] = None
+    team: Optional[str] = None
+    namecheap: Optional[NamecheapAccount] = None
+    hestia_collector: str = "api"
+    hestia_data_dir: str = "/usr/local/hestia/data"
+    hestia_concurrency: int = 8
+    hestia_user_timeout: float = 30
+    # prefix of this target's keys in shared stores; "" for the target of
+    # an env-configured deployment, so its state file keeps working
+    key: str = ""
+
+    # runtime state, set up by main at startup
+    store: object = field(default=None, repr=False, compare=False)
+    identity: dict = field(default_factory=dict, repr=False, compare=False)
+    domain_index: object = field(default=None, repr=False, compare=False)
+    domain_index_source: Optional[str] = field(default=None, repr=False, compare=False)
+    last_sync: Optional[dict] = field(default=None, repr=False, compare=False)
+    last_successful_sync: Optional[dict] = field(default=None, repr=False, compare=False)
+    sync_runner: object = field(default=None, repr=False, compare=False)
+    sources: list = field(default_factory=list, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.panel = self.panel.lower()
+        if self.panel not in ("whm", "hestia"):
+            raise ValueError(f"Target {self.name}: panel must be whm or hestia")
+        if self.panel_url is None:
+            self.panel_url = f"https://{self.host}:2087" if self.panel == "whm" else "https://127.0.0.1:8083"
+        self.panel_url = self.panel_url.rstrip("/")
+        self.hestia_collector = self.hestia_collector.lower()
+
+    @classmethod
+    def from_env(cls) -> "Target":
+        """The single target of a deployment configured by env vars."""
+        panel = os.getenv("PANEL_TYPE", "whm")
+        no_nc = os.getenv("NO_NC", "false").lower() == "true"
+        return cls(
+            name=os.getenv("NAME"),
+            panel=panel,
+            host=os.getenv("CLIENT_IP"),
+            api_key=os.getenv("HESTIA_API_KEY" if panel.lower() == "hestia" else "WHM_API_KEY"),
+            team=os.getenv("TEAM"),
+            namecheap=None if no_nc else NamecheapAccount.from_env(),
+            hestia_collector=os.getenv("HESTIA_COLLECTOR", "api"),
+            hestia_data_dir=os.getenv("HESTIA_DATA_DIR", "/usr/local/hestia/data"),
+            hestia_concurrency=int(os.getenv("HESTIA_CONCURRENCY", 8)),
+            hestia_user_timeout=float(os.getenv("HESTIA_USER_TIMEOUT", 30)),
+        )
+
+
+def _substitute(match: re.Match) -> str:
+    value = os.environ.get(match.group(1))
+    if value is None:
+        raise ValueError(f"Environment variable {match.group(1)} is not set")
+    return value
+
+
+def _expand(value):
+    """Substitute ${VAR} in config strings, so secrets can stay in the environment.
+
+    Only the braced form is replaced; a bare $name is kept as written.
+    Raises ValueError for a variable that is not set.
+    """
+    if isinstance(value, str):
+        return _VAR.sub(_substitute, value)
+    if isinstance(value, dict):
+        return {k: _expand(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_expand(v) for v in value]
+    return value
+
+
+def load_targets(path: str, upstreams=()) -> tuple[list[Target], dict]:
+    """Read a targets file; returns (targets, top-level options).
+
+        {
+          "namecheap": {"main": {"api_user": "...", "api_key": "${NC_KEY}", "client_ip": "..."}},
+          "targets": [
+            {"name": "web1", "panel": "whm", "host": "203.0.113.10", "api_key": "...", "namecheap": "main"},
+            {"name": "web2", "panel": "hestia", "host": "203.0.113.11",
+             "panel_url": "https://203.0.113.11:8083", "api_key": "...", "team": "other"}
+          ],
+          "concurrency": 8,
+          "http": {"backend": {"http2": true, "max_connections": 40}}
+        }
+
+    `upstreams` names the HTTP clients "http" may configure, each with
+    UpstreamSettings fields. Raises ValueError for a file that does not describe a usable set of targets.
+    """
+    with open(path, encoding="utf-8") as f:
+        config = _expand(json.load(f))
+
+    accounts = {}
+    for name, settings in (config.get("namecheap") or {}).items():
+        try:
+            accounts[name] = NamecheapAccount(name=name, **settings)
+        except TypeError as e:
+            raise ValueError(f"NameCheap account {name}: {e}") from None
+
+    targets = []
+    for settings in config.get("targets") or []:
+        settings = dict(settings)
+        name = settings.get("name")
+        if not name or not _NAME.match(name):
+            raise ValueError(f"Invalid target name {name!r}: use letters, digits, '_', '.' and '-'")
+        if any(t.name == name for t in targets):
+            raise ValueError(f"Duplicate target name {name}")
+        account = settings.pop("namecheap", None)
+        if account is not None and account not in accounts:
+            raise ValueError(f"Target {name}: unknown NameCheap account {account}")
+        settings.pop("key", None)
+        try:
+            targets.append(Target(**settings, namecheap=accounts.get(account), key=f"{name}/"))
+        except TypeError as e:
+            raise ValueError(f"Target {name}: {e}") from None
+    if not targets:
+        raise ValueError(f"{path} lists no targets")
+
+    settings_fields = {f.name for f in fields(UpstreamSettings)}
+    for name, settings in (config.get("http") or {}).items():
+        if name not in upstreams:
+            raise ValueError(f"HTTP upstream {name}: unknown, expected one of {', '.join(upstreams)}")
+        if not isinstance(settings, dict):
+            raise ValueError(f"HTTP upstream {name}: settings must be an object")
+        unknown = sorted(set(settings) - settings_fields)
+        if unknown:
+            raise ValueError(f"HTTP upstream {name}: unknown setting(s) {', '.join(unknown)}")
+
+    options = {k: v for k, v in config.items() if k not in ("namecheap", "targets")}
+    return targets, options
@@ -0,0 +1,91 @@
+import gzip
+import asyncio
+import uuid
+import httpx
+from service.serialize import dumps
+from service.jobs import report_progress
+
+
+def _encode(body: dict, compress: bool) -> bytes:
+    data = dumps(body)
+    return gzip.compress(data, compresslevel=5) if compress else data
+
+
+async def _post_with_retries(client: httpx.AsyncClient, url: str, headers: dict, content: bytes, retries: int):
+    delay = 1
+    for attempt in range(1, max(1, retries) + 1):
+        try:
+            r = await client.post(url, content=content, headers=headers)
+            r.raise_for_status()
+            return r
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            if (status < 500 and status != 429) or attempt >= retries:
+                raise
+        except httpx.TransportError:
+            if attempt >= retries:
+                raise
+        await asyncio.sleep(delay)
+        delay *= 2
+
+
+async def post_in_batches(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: dict,
+    items: list,
+    make_body,
+    batch_size: int = 0,
+    concurrency: int = 2,
+    compress: bool = False,
+    retries: int = 3,
+) -> tuple[list[int], list[tuple[int, Exception]]]:
+    """POST `items` to `url` in batches of `batch_size` (all in one with 0).
+
+    `make_body(index, total, chunk)` builds the JSON body of one batch.
+    Batches are encoded in a worker thread while earlier ones are still in
+    flight, at most `concurrency` are sent at once, and each one is retried
+    on its own under an Idempotency-Key made of an id of this call and the
+    batch index, so only retries of the same batch share a key. Always
+    sends at least one batch, even for an empty item list.
+
+    Returns (indexes of batches that were accepted, [(index, error), ...]).
+    """
+    if batch_size <= 0:
+        batch_size = max(1, len(items))
+    concurrency = max(1, concurrency)
+    total = max(1, (len(items) + batch_size - 1) // batch_size)
+    report_progress("batchesTotal", total)
+    queue = asyncio.Queue(maxsize=concurrency)
+    run_id = uuid.uuid4().hex
+    sent = []
+    failed = []
+
+    base_headers = {**headers, "Content-Type": "application/json"}
+    if compress:
+        base_headers["Content-Encoding"] = "gzip"
+
+    async def produce():
+        try:
+            for index in range(total):
+                chunk = items[index * batch_size:(index + 1) * batch_size]
+                content = await asyncio.to_thread(_encode, make_body(index, total, chunk), compress)
+                await queue.put((index, content))
+        finally:
+            for _ in range(concurrency):
+                await queue.put(None)
+
+    async def consume():
+        while (job := await queue.get()) is not None:
+            index, content = job
+            batch_headers = {**base_headers, "Idempotency-Key": f"{run_id}-{index}"}
+            try:
+                await _post_with_retries(client, url, batch_headers, content, retries)
+                sent.append(index)
+                report_progress("batchesUploaded")
+            except Exception as e:
+                failed.append((index, e))
+                report_progress("batchesFailed")
+
+    await asyncio.gather(produce(), *[consume() for _ in range(concurrency)])
+    return sorted(sent), sorted(failed, key=lambda f: f[0])
@@ -1,25 +1,28 @@
-import os
 import httpx
+from service.bandwidth import parse_showbw
+from service.targets import Target
 
-CLIENT_IP = os.getenv("CLIENT_IP")
-WHM_API_KEY = os.getenv("WHM_API_KEY")
 
-
-async def get_bandwidth(client: httpx.AsyncClient):
-    """Fetch bandwidth from WHM.
+async def get_bandwidth(client: httpx.AsyncClient, target: Target):
+    """Fetch bandwidth from the WHM of `target`.
 
     httpx.AsyncClient.get() does not accept a `verify` kwarg per-request in
     some versions; verify should be set on the client. The caller may pass an
     AsyncClient already configured with the desired `verify` and `timeout`.
+
+    With BANDWIDTH_DETAIL=top/none the body is parsed as it streams in and
+    each account is compacted on the way, so the full showbw document is
+    never held in memory; with "full" it is read whole (see
+    service.bandwidth.parse_showbw).
     """
-    WHM_API_URL = f"https://{CLIENT_IP}:2087/json-api/showbw?api.version=1"
+    WHM_API_URL = f"{target.panel_url}/json-api/showbw?api.version=1"
     try:
-        r = await client.get(
+        async with client.stream(
+            "GET",
             WHM_API_URL,
-            headers={"Authorization": f"WHM root:{WHM_API_KEY}"},
-            timeout=30,
-        )
-        r.raise_for_status()
-        return r.json()
+            headers={"Authorization": f"WHM root:{target.api_key}"},
+        ) as r:
+            r.raise_for_status()
+            return await parse_showbw(r.aiter_bytes())
     except Exception as e:
         return {"error": str(e)}
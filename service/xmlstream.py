@@ -0,0 +1,141 @@
+import xml.etree.ElementTree as ET
+
+
+def _local(tag: str) -> str:
+    """Drop the xmlns part: "{http://api.namecheap.com/xml.response}Domain" -> "Domain"."""
+    return tag.rsplit("}", 1)[-1]
+
+
+class NamecheapResponseParser:
+    """Incremental parser for NameCheap xml.response bodies.
+
+    Feed raw bytes as they arrive; every completed `item_tag` element comes
+    back as a dict of its attributes (keys prefixed with `prefix`). Elements
+    are dropped from the tree once they are closed, so the parser itself only
+    holds the open elements; whatever the caller keeps of the items is up to
+    the caller. Attributes of the `capture` elements and the text of the
+    `capture_text` elements end up in `results` / `texts`.
+    """
+
+    def __init__(self, item_tag: str | None = None, prefix: str = "", capture=(), capture_text=()):
+        self.item_tag = item_tag
+        self.prefix = prefix
+        self.capture = set(capture)
+        self.capture_text = set(capture_text)
+        self.status = None
+        self.errors = []
+        self.results = {}
+        self.texts = {}
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._stack = []
+        self._seen_root = False
+
+    def feed(self, data: bytes) -> list[dict]:
+        self._parser.feed(data)
+        return self._drain()
+
+    def close(self) -> list[dict]:
+        try:
+            self._parser.close()
+        except ET.ParseError:
+            # an empty body is reported by error(), anything else is a real problem
+            if self._seen_root:
+                raise
+        return self._drain()
+
+    def _drain(self) -> list[dict]:
+        items = []
+        for event, elem in self._parser.read_events():
+            tag = _local(elem.tag)
+            if event == "start":
+                if not self._stack:
+                    self._seen_root = True
+                    self.status = elem.get("Status")
+                if tag in self.capture:
+                    self.results[tag] = dict(elem.attrib)
+                self._stack.append(elem)
+                continue
+
+            self._stack.pop()
+            parent = self._stack[-1] if self._stack else None
+            if tag == self.item_tag:
+                if self.prefix:
+                    items.append({self.prefix + k: v for k, v in elem.attrib.items()})
+                else:
+                    items.append(dict(elem.attrib))
+            elif tag == "Error" and parent is not None and _local(parent.tag) == "Errors":
+                self.errors.append((elem.text or "").strip())
+            elif tag in self.capture_text:
+                self.texts[tag] = elem.text
+            if parent is not None:
+                parent.remove(elem)
+        return items
+
+    def error(self) -> str | None:
+        """Same messages as the error check done on xmltodict output."""
+        if not self._seen_root:
+            return "Empty response from NameCheap"
+        if str(self.status or "").upper() != "ERROR":
+            return None
+        if not self.errors:
+            return "NameCheap API error (no error details)"
+        return "; ".join(e for e in self.errors if e) or "NameCheap API error"
+
+
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+    import xmltodict
+
+    def _domains_page(n):
+        rows = "".join(
+            f'<Domain ID="{i}" Name="domain{i}.com" User="user" Created="01/02/2020" '
+            f'Expires="01/02/2030" IsExpired="false" IsLocked="false" AutoRenew="true" '
+            f'WhoisGuard="ENABLED" IsPremium="false" IsOurDNS="true"/>'
+            for i in range(n)
+        )
+        return (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<ApiResponse Status="OK" xmlns="http://api.namecheap.com/xml.response">'
+            '<Errors /><CommandResponse Type="namecheap.domains.getList">'
+            f'<DomainGetListResult>{rows}</DomainGetListResult>'
+            f'<Paging><TotalItems>{n}</TotalItems><CurrentPage>1</CurrentPage><PageSize>{n}</PageSize></Paging>'
+            '</CommandResponse></ApiResponse>'
+        ).encode()
+
+    def _with_xmltodict(body):
+        data = xmltodict.parse(body.decode())
+        result = data["ApiResponse"]["CommandResponse"]["DomainGetListResult"]
+        return result.get("Domain") or []
+
+    def _with_stream(body, chunk=16 * 1024):
+        parser = NamecheapResponseParser(item_tag="Domain", prefix="@", capture_text=("TotalItems",))
+        rows = []
+        for i in range(0, len(body), chunk):
+            rows.extend(parser.feed(body[i:i + chunk]))
+        rows.extend(parser.close())
+        return rows
+
+    def _count_stream(body, chunk=16 * 1024):
+        # rows consumed as they arrive, nothing kept: not what the crawl does,
+        # it keeps every row for allDomains (see _with_stream)
+        parser = NamecheapResponseParser(item_tag="Domain", prefix="@")
+        count = 0
+        for i in range(0, len(body), chunk):
+            count += len(parser.feed(body[i:i + chunk]))
+        return count + len(parser.close())
+
+    for n in (100, 10000):
+        body = _domains_page(n)
+        assert _with_xmltodict(body) == _with_stream(body)
+        rounds = max(3, 2000 // n)
+        for label, fn in (("xmltodict", _with_xmltodict), ("stream", _with_stream), ("consume", _count_stream)):
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                fn(body)
+            elapsed = (time.perf_counter() - t0) / rounds
+            tracemalloc.start()
+            fn(body)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{n:>6} domains  {label:<10} {elapsed * 1000:8.2f} ms  peak {peak / 1024:9.1f} KiB")
@@ -0,0 +1,54 @@
+import json
+import asyncio
+
+import httpx
+
+from service.clients import ClientRegistry, UpstreamSettings
+from service.hestia import fetch_all
+from service.targets import Target
+from service.whm import get_bandwidth
+
+SHOWBW = {"metadata": {"result": 1}, "data": {"month": 1, "year": 2024, "acct": []}}
+
+
+def _fake_upstream(monkeypatch) -> list:
+    """Answer every request without a network; returns the timeouts the requests carried."""
+    seen = []
+
+    async def handle(transport, request):
+        seen.append((request.url.path, request.extensions["timeout"]))
+        if request.url.path.startswith("/json-api/"):
+            return httpx.Response(200, content=json.dumps(SHOWBW).encode())
+        cmd = dict(httpx.QueryParams((await request.aread()).decode()))["cmd"]
+        body = {"alice": {}} if cmd == "v-list-users" else {"alice.example": {"U_BANDWIDTH": "1"}}
+        return httpx.Response(200, json=body)
+
+    monkeypatch.setattr(httpx.AsyncHTTPTransport, "handle_async_request", handle)
+    return seen
+
+
+def test_upstream_timeouts_reach_whm_and_hestia_requests(monkeypatch):
+    seen = _fake_upstream(monkeypatch)
+    clients = ClientRegistry()
+    clients.add("whm", UpstreamSettings(timeout=12, pool_timeout=7, verify=False))
+    clients.add("hestia", UpstreamSettings(timeout=9, pool_timeout=3, verify=False))
+
+    async def run():
+        whm = Target(name="web1", panel="whm", host="203.0.113.10", api_key="key")
+        hestia = Target(name="web2", panel="hestia", host="203.0.113.11", api_key="key")
+        bandwidth = await get_bandwidth(clients.get("whm"), whm)
+        hestia_bandwidth, domains = await fetch_all(clients.get("hestia"), hestia)
+        await clients.aclose()
+        return bandwidth, hestia_bandwidth, domains
+
+    bandwidth, hestia_bandwidth, domains = asyncio.run(run())
+    assert "error" not in bandwidth and "error" not in hestia_bandwidth
+    assert [d["Name"] for d in domains] == ["alice.example"]
+
+    whm_timeout = {"connect": 12, "read": 12, "write": 12, "pool": 7}
+    hestia_timeout = {"connect": 9, "read": 9, "write": 9, "pool": 3}
+    assert seen == [
+        ("/json-api/showbw", whm_timeout),
+        ("/api/", hestia_timeout),
+        ("/api/", hestia_timeout),
+    ]
@@ -0,0 +1,75 @@
+import os
+import asyncio
+
+from service.hestia import _parse_conf_line, _read_user_dir, _scan_data_dir, fetch_all
+from service.targets import Target
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "hestia")
+
+
+def _target(data_dir: str = DATA_DIR) -> Target:
+    return Target(name="web1", panel="hestia", host="203.0.113.11", hestia_collector="files", hestia_data_dir=data_dir)
+
+
+def test_parse_conf_line():
+    line = "DOMAIN='a.example' IP='203.0.113.11' U_BANDWIDTH='' lower='x'"
+    assert _parse_conf_line(line) == {"DOMAIN": "a.example", "IP": "203.0.113.11", "U_BANDWIDTH": ""}
+    assert _parse_conf_line("this line is not a conf line") == {}
+
+
+def test_read_user_dir_skips_lines_without_domain():
+    uinfo, domains = _read_user_dir(os.path.join(DATA_DIR, "users", "alice"))
+    assert uinfo["NAME"] == "Alice Example"
+    assert uinfo["SUSPENDED"] == "no"
+    assert sorted(domains) == ["alice.example", "shop.alice.example"]
+    assert domains["alice.example"]["U_BANDWIDTH"] == "100"
+    assert "DOMAIN" not in domains["alice.example"]
+
+
+def test_read_user_dir_missing_files():
+    assert _read_user_dir(os.path.join(DATA_DIR, "users", "carol")) == ({"NAME": "Carol Example", "PACKAGE": "default"}, {})
+    assert _read_user_dir(os.path.join(DATA_DIR, "users", "nobody")) == ({}, {})
+
+
+def test_scan_data_dir():
+    users = {username: (uinfo, domains, error) for username, uinfo, domains, error in _scan_data_dir(DATA_DIR)}
+    # admin is never reported and files next to the user directories are ignored
+    assert sorted(users) == ["alice", "bob", "carol", "dave"]
+    assert users["bob"][1] == {
+        "bob.example": {"IP": "203.0.113.11", "U_BANDWIDTH": "", "SUSPENDED": "no", "DATE": "2023-12-31"}
+    }
+    assert users["carol"] == ({"NAME": "Carol Example", "PACKAGE": "default"}, {}, None)
+    # an unreadable web.conf is that user's error, not the whole scan's
+    uinfo, domains, error = users["dave"]
+    assert (uinfo, domains) == ({}, {})
+    assert "decode" in error
+
+
+def test_fetch_all_from_files():
+    bandwidth, domains = asyncio.run(fetch_all(None, _target()))
+
+    assert bandwidth["errors"] == [{"user": "dave", "error": bandwidth["errors"][0]["error"]}]
+    accounts = {a["user"]: a for a in bandwidth["data"]["acct"]}
+    assert sorted(accounts) == ["alice", "bob"]
+    alice = accounts["alice"]
+    assert alice["maindomain"] == "alice.example"
+    assert alice["totalbytes"] == 100 * 1024 * 1024 + 512 * 1024
+    assert {e["domain"]: e["usage"] for e in alice["bwusage"]} == {
+        "alice.example": str(100 * 1024 * 1024),
+        "shop.alice.example": str(512 * 1024),
+    }
+    assert accounts["bob"]["totalbytes"] == 0
+    assert bandwidth["data"]["totalused"] == str(alice["totalbytes"])
+
+    by_name = {d["Name"]: d for d in domains}
+    assert sorted(by_name) == ["alice.example", "bob.example", "shop.alice.example"]
+    assert by_name["shop.alice.example"]["IsExpired"] == "true"
+    assert by_name["alice.example"]["IsExpired"] == "false"
+    assert by_name["alice.example"]["Created"] == "2024-01-05"
+    assert by_name["bob.example"]["User"] == "bob"
+
+
+def test_fetch_all_missing_data_dir(tmp_path):
+    bandwidth, domains = asyncio.run(fetch_all(None, _target(str(tmp_path / "missing"))))
+    assert "error" in bandwidth
+    assert domains == []
@@ -0,0 +1,103 @@
+import asyncio
+
+from service.jobs import SyncRunner, _RUN_LEASE
+from service.state import StateStore
+
+
+def test_shutdown_fails_the_running_job_and_releases_the_lease(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+
+    async def run():
+        await asyncio.sleep(30)
+
+    async def scenario():
+        runner = SyncRunner(run, store=store, holder="worker-1")
+        job, _ = await runner.trigger("api")
+        await asyncio.sleep(0)
+        await runner.shutdown()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.status == "failed"
+    assert "shut down" in job.error
+    assert store.lease_holder(_RUN_LEASE) is None
+    assert store.get(f"sync_job:{job.id}")["status"] == "failed"
+    assert store.get("sync_job_last") == job.id
+
+
+def _runs(log: list, name: str, gate: asyncio.Event = None):
+    async def run():
+        log.append(f"{name} start")
+        if gate is not None:
+            await gate.wait()
+        log.append(f"{name} end")
+        return name
+    return run
+
+
+def test_full_trigger_during_inventory_job_is_queued(tmp_path):
+    log = []
+
+    async def scenario(store):
+        gate = asyncio.Event()
+        runner = SyncRunner(_runs(log, "full"), store=store, holder="worker-1")
+        inventory, _ = await runner.trigger("inventory", run=_runs(log, "inventory", gate), kind="inventory")
+        await asyncio.sleep(0)
+
+        full, attached = await runner.trigger("api")
+        assert not attached
+        assert full is not inventory
+        assert (full.kind, full.status) == ("full", "queued")
+        # more full triggers wait for the queued job, inventory ones attach to the running one
+        assert await runner.trigger("api") == (full, True)
+        assert await runner.trigger("inventory", kind="inventory") == (inventory, True)
+
+        gate.set()
+        await full.wait()
+        return inventory, full
+
+    for store in (None, StateStore(str(tmp_path / "state.db"))):
+        log.clear()
+        inventory, full = asyncio.run(scenario(store))
+        assert log == ["inventory start", "inventory end", "full start", "full end"]
+        assert (inventory.status, full.status, full.result) == ("succeeded", "succeeded", "full")
+    assert store.lease_holder(_RUN_LEASE) is None
+    assert store.get(f"sync_job:{full.id}")["kind"] == "full"
+
+
+def test_full_trigger_queues_behind_another_workers_inventory_job(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    log = []
+
+    async def scenario():
+        gate = asyncio.Event()
+        first = SyncRunner(_runs(log, "full 1"), store=store, holder="worker-1")
+        second = SyncRunner(_runs(log, "full 2"), store=store, holder="worker-2")
+        inventory, _ = await first.trigger("inventory", run=_runs(log, "inventory", gate), kind="inventory")
+        await asyncio.sleep(0)
+
+        full, attached = await second.trigger("api")
+        assert not attached
+        assert full.status == "queued"
+
+        gate.set()
+        await asyncio.wait_for(full.wait(), 10)
+        return full
+
+    full = asyncio.run(scenario())
+    assert log == ["inventory start", "inventory end", "full 2 start", "full 2 end"]
+    assert full.status == "succeeded"
+
+
+def test_inventory_trigger_attaches_to_a_full_job():
+    async def scenario():
+        gate = asyncio.Event()
+        runner = SyncRunner(_runs([], "full", gate))
+        full, _ = await runner.trigger("api")
+        job, attached = await runner.trigger("inventory", run=_runs([], "inventory"), kind="inventory")
+        gate.set()
+        await full.wait()
+        return full, job, attached
+
+    full, job, attached = asyncio.run(scenario())
+    assert attached and job is full
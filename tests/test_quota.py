@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from service.quota import QuotaScheduler
+from service.state import StateStore
+
+
+def _grants(schedulers, attempts: int) -> int:
+    """How many of `attempts` acquires, spread over `schedulers`, are granted right away."""
+    async def run():
+        granted = 0
+        for i in range(attempts):
+            try:
+                await asyncio.wait_for(schedulers[i % len(schedulers)].acquire(), 0.2)
+                granted += 1
+            except asyncio.TimeoutError:
+                pass
+        return granted
+    return asyncio.run(run())
+
+
+def test_workers_sharing_a_store_share_the_quota(tmp_path):
+    # two processes opening the same state file
+    first = StateStore(str(tmp_path / "state.db"))
+    second = StateStore(str(tmp_path / "state.db"))
+    schedulers = [
+        QuotaScheduler([(3, 60), (100, 3600)], store=first, name="namecheap:user"),
+        QuotaScheduler([(3, 60), (100, 3600)], store=second, name="namecheap:user"),
+    ]
+    assert _grants(schedulers, 5) == 3
+    assert schedulers[0].stats()["shared"] is True
+
+
+def test_separate_names_and_local_buckets_are_independent(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    assert _grants([QuotaScheduler([(2, 60)], store=store, name="namecheap:a")], 3) == 2
+    assert _grants([QuotaScheduler([(2, 60)], store=store, name="namecheap:b")], 3) == 2
+    assert _grants([QuotaScheduler([(2, 60)]), QuotaScheduler([(2, 60)])], 5) == 4
+
+
+def test_take_quota_refills_over_time(tmp_path, monkeypatch):
+    store = StateStore(str(tmp_path / "state.db"))
+    now = [1000.0]
+    monkeypatch.setattr("service.state.time.time", lambda: now[0])
+
+    assert store.take_quota("q", [(1, 60)])[0] == 0
+    wait, levels = store.take_quota("q", [(1, 60)])
+    assert wait == pytest.approx(60)
+    assert levels == [pytest.approx(0)]
+    now[0] += 30
+    assert store.take_quota("q", [(1, 60)])[0] == pytest.approx(30)
+    now[0] += 30
+    assert store.take_quota("q", [(1, 60)])[0] == 0